@@ -1,32 +1,1127 @@
 import argparse
+import copy
+import email.utils
+import http.client
 import http.server
+import json
 import os
 import pickle
+import re
+import shutil
 import signal
 import socketserver
 import ssl
+import struct
 import sys
-import urllib.request
+import threading
+import time
 import urllib.parse
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
-CACHE = {}
-CACHE_FILE = 'cache.pkl'
-
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, 'rb') as f:
-        CACHE = pickle.load(f)
+CACHE_DIR = 'cache'
+# the pickled dict used by older versions, imported into the store on first start
+LEGACY_CACHE_FILE = 'cache.pkl'
+# opened in __main__ once the arguments are parsed
+CACHE = None
+# freshness in seconds for responses without any caching headers, --default-ttl
+DEFAULT_TTL = 300
+# seconds a stale entry may still be served while it is refreshed, --stale-while-revalidate
+STALE_WHILE_REVALIDATE = 0
+# origin fetches in flight, shared by concurrent requests for the same key
+FLIGHTS = None
+# keep-alive connections to the origin
+ORIGIN_POOL = None
+# the proxy's own endpoints, these paths are never forwarded to the origin
+STATS_PATH = '/__stats'
+METRICS_PATH = '/__metrics'
+PROFILE_PATH = '/__profile'
+# the request target of a GET line in a common/combined format access log
+ACCESS_LOG_REQUEST = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+# the heuristic freshness derived from Last-Modified is capped at a day
+MAX_HEURISTIC_TTL = 24 * 60 * 60
+# status codes which may be cached without explicit freshness information (RFC 9111)
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+# responses which never have a body, nor the Content-Length or Transfer-Encoding of one (1xx aside)
+NO_BODY_STATUS = {204, 304}
+# headers which only apply to a single connection and are never stored or forwarded
+HOP_BY_HOP = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+# the proxy sets these itself when talking to the origin or the client
+NOT_FORWARDED = HOP_BY_HOP | {
+    'host', 'content-length', 'if-none-match', 'if-modified-since', 'range', 'if-range',
+}
+# origin headers describing that one response, the proxy sends its own when it answers from the cache
+NOT_STORED = {'server', 'date'}
+# request headers which make the response private to the client unless the origin marks it shareable
+CREDENTIALS = ('authorization', 'cookie')
+# bodies larger than this are streamed to the client but not cached, --max-cacheable-mb
+MAX_CACHEABLE_SIZE = 64 * 1024 * 1024
+# bytes read from the origin and written to the client at a time
+CHUNK_SIZE = 64 * 1024
+# zlib level bodies are stored gzip compressed with, 0 stores them as received, --compress-level
+COMPRESS_LEVEL = 0
+# smaller bodies are not worth compressing
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+)
 
 # Disable SSL verification
 context = ssl._create_unverified_context()
 
 def signal_handler(sig, frame):
-    """Handle Ctrl+C when user exits the program.
+    """Handle Ctrl+C when user exits the program (or a SIGTERM), the writes to
+    the store still outstanding are finished first.
     """
     print('Interrupt received, shutting down...')
+    if CACHE is not None:
+        CACHE.flush()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
+
+
+class CacheStore:
+    """Append-only on-disk store for the cached responses.
+
+    Every put appends one record to the active segment file, so a write costs
+    the size of that entry only. Records are laid out as
+    <header><key><meta><body>, only the index (key -> location of the body) and
+    the small meta blob are held in memory, bodies are read from disk on demand.
+    Overwritten and deleted records are left behind as garbage and reclaimed by
+    compact(), which runs on a background thread once the garbage ratio is
+    exceeded.
+
+    Args:
+        path (str): directory holding the segment files.
+        segment_size (int): roll over to a new segment file after this many bytes.
+        compact_ratio (float): compact when this fraction of the stored bytes is garbage.
+        compact_min (int): never compact stores smaller than this many bytes.
+    """
+    # flags, key length, meta length, body length
+    HEADER = struct.Struct('>BHII')
+    TOMBSTONE = 1
+    SEGMENT_NAME = 'segment-{:06d}.log'
+    SEGMENT_PATTERN = re.compile(r'segment-(\d{6})\.log$')
+
+    def __init__(self, path: str, segment_size: int = 64 * 1024 * 1024,
+                 compact_ratio: float = 0.5, compact_min: int = 16 * 1024 * 1024) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.lock = threading.RLock()
+        # key -> (segment id, body offset, body length, record length, meta)
+        self.index = {}
+        self.readers = {}
+        self.total_bytes = 0
+        self.dead_bytes = 0
+        self.compacting = False
+
+        os.makedirs(path, exist_ok=True)
+        segment_ids = sorted(
+            int(m.group(1)) for m in map(self.SEGMENT_PATTERN.match, os.listdir(path)) if m
+        )
+        for segment_id in segment_ids:
+            self._load_segment(segment_id)
+        self.active_id = segment_ids[-1] if segment_ids else 1
+        self._open_active()
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.path, self.SEGMENT_NAME.format(segment_id))
+
+    def _load_segment(self, segment_id: int) -> None:
+        """Rebuild the index from the record headers of one segment, the bodies
+        are skipped over and never read. A partially written record at the end
+        of the file (eg. after a crash) is truncated away.
+        """
+        path = self._segment_path(segment_id)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            offset = 0
+            while offset < size:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                flags, key_len, meta_len, body_len = self.HEADER.unpack(header)
+                record_len = self.HEADER.size + key_len + meta_len + body_len
+                if offset + record_len > size:
+                    break
+                key = f.read(key_len).decode('utf-8')
+                meta = f.read(meta_len)
+                body_offset = offset + self.HEADER.size + key_len + meta_len
+                f.seek(body_len, os.SEEK_CUR)
+
+                self._forget(key)
+                if flags & self.TOMBSTONE:
+                    self.dead_bytes += record_len
+                else:
+                    self.index[key] = (segment_id, body_offset, body_len, record_len, meta)
+                self.total_bytes += record_len
+                offset += record_len
+
+        if offset < size:
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        self.readers[segment_id] = open(path, 'rb')
+
+    def _open_active(self) -> None:
+        path = self._segment_path(self.active_id)
+        self.writer = open(path, 'ab', buffering=0)
+        self.active_size = self.writer.tell()
+        if self.active_id not in self.readers:
+            self.readers[self.active_id] = open(path, 'rb')
+
+    def _forget(self, key: str) -> None:
+        """Mark the current record of `key`, if any, as garbage.
+        """
+        old = self.index.pop(key, None)
+        if old:
+            self.dead_bytes += old[3]
+
+    def _append(self, key: str, body: bytes, meta: bytes, flags: int = 0) -> tuple:
+        if self.active_size >= self.segment_size:
+            self.writer.close()
+            self.active_id += 1
+            self._open_active()
+
+        key_bytes = key.encode('utf-8')
+        header = self.HEADER.pack(flags, len(key_bytes), len(meta), len(body))
+        record = b''.join((header, key_bytes, meta, body))
+        offset = self.active_size
+        self.writer.write(record)
+        self.active_size += len(record)
+        self.total_bytes += len(record)
+        body_offset = offset + len(header) + len(key_bytes) + len(meta)
+        return (self.active_id, body_offset, len(body), len(record), meta)
+
+    def get(self, key: str) -> bytes:
+        """Return the body stored for `key` or None.
+        """
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def get_entry(self, key: str) -> tuple:
+        """Return (body, meta) stored for `key` or None.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            segment_id, body_offset, body_len, _, meta = entry
+            return os.pread(self.readers[segment_id].fileno(), body_len, body_offset), meta
+
+    def get_meta(self, key: str) -> bytes:
+        """Return the meta blob stored for `key` without touching the disk.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            return entry[4] if entry else None
+
+    def put(self, key: str, body: bytes, meta: bytes = b'') -> None:
+        """Append `body` for `key`, replacing any earlier entry.
+        """
+        with self.lock:
+            entry = self._append(key, body, meta)
+            self._forget(key)
+            self.index[key] = entry
+            self._maybe_compact()
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            if key not in self.index:
+                return
+            self._forget(key)
+            self.dead_bytes += self._append(key, b'', b'', flags=self.TOMBSTONE)[3]
+            self._maybe_compact()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'segments': len(self.readers),
+                'total_bytes': self.total_bytes,
+                'dead_bytes': self.dead_bytes,
+            }
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.index)
+
+    def _maybe_compact(self) -> None:
+        # called with the lock held, the compaction itself runs on its own thread so the put that
+        # crossed the threshold doesn't pay for rewriting the store
+        if self.compacting:
+            return
+        if self.total_bytes >= self.compact_min and self.dead_bytes >= self.total_bytes * self.compact_ratio:
+            self.compacting = True
+            threading.Thread(target=self._compact_background, daemon=True).start()
+
+    def _compact_background(self) -> None:
+        try:
+            self.compact()
+        except Exception as error:
+            print(f'Compaction of {self.path} failed: {error}')
+        finally:
+            self.compacting = False
+
+    def compact(self) -> None:
+        """Copy the live records into a fresh segment and remove the old
+        segments, reclaiming the space held by overwritten and deleted entries.
+        The copy is made without holding the lock: writes go to a segment after
+        the compacted one in the meantime, and at the end the index is switched
+        over to the copies of the entries which were not replaced since.
+        """
+        with self.lock:
+            old_ids = sorted(self.readers)
+            live = dict(self.index)
+            readers = dict(self.readers)
+            compact_id = old_ids[-1] + 1
+            self.writer.close()
+            self.active_id = compact_id + 1
+            self._open_active()
+
+        copies = {}
+        offset = 0
+        with open(self._segment_path(compact_id), 'wb') as f:
+            for key, (segment_id, body_offset, body_len, _, meta) in live.items():
+                body = os.pread(readers[segment_id].fileno(), body_len, body_offset)
+                key_bytes = key.encode('utf-8')
+                header = self.HEADER.pack(0, len(key_bytes), len(meta), len(body))
+                record = b''.join((header, key_bytes, meta, body))
+                f.write(record)
+                copies[key] = (compact_id, offset + len(record) - len(body), len(body), len(record), meta)
+                offset += len(record)
+
+        with self.lock:
+            for key, copy in copies.items():
+                if self.index.get(key) is live[key]:
+                    self.index[key] = copy
+            self.readers[compact_id] = open(self._segment_path(compact_id), 'rb')
+            for segment_id in old_ids:
+                self.readers.pop(segment_id).close()
+                os.unlink(self._segment_path(segment_id))
+            self.total_bytes = sum(os.fstat(reader.fileno()).st_size for reader in self.readers.values())
+            self.dead_bytes = self.total_bytes - sum(entry[3] for entry in self.index.values())
+
+    def close(self) -> None:
+        with self.lock:
+            self.writer.close()
+            for reader in self.readers.values():
+                reader.close()
+            self.readers.clear()
+
+
+class LRUCache:
+    """Bounded in-memory cache in front of the on-disk store.
+
+    Entries are kept in least recently used order and dropped once either the
+    byte budget or the entry count is exceeded. Every new entry is written
+    through to the store, after the lock is released so memory hits never wait
+    on the disk, and is served from `pending` until the write lands. Entries
+    read back from the store are kept in memory as copies, evicting them costs
+    nothing.
+
+    Args:
+        max_bytes (int): budget for the bodies held in memory.
+        max_entries (int): maximum number of entries held in memory.
+        spill (CacheStore): store every new entry is written to, None to keep them in memory only.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_entries: int = 10000,
+                 spill: CacheStore = None) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.spill = spill
+        self.lock = threading.Lock()
+        # key -> (body, meta)
+        self.entries = OrderedDict()
+        # key -> (body, meta) put but not yet written to the store
+        self.pending = {}
+        # keeps the store writes in order
+        self.spill_lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+
+    def get(self, key: str) -> bytes:
+        """Return the body for `key` from memory or the store, None on a miss.
+        """
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def get_entry(self, key: str) -> tuple:
+        """Return (body, meta) for `key` from memory or the store, None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            entry = self.pending.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        entry = self.spill.get_entry(key) if self.spill is not None else None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            if key not in self.entries:
+                self._insert(key, entry)
+        return entry
+
+    def get_meta(self, key: str) -> bytes:
+        with self.lock:
+            entry = self.entries.get(key) or self.pending.get(key)
+            if entry is not None:
+                return entry[1]
+        return self.spill.get_meta(key) if self.spill is not None else None
+
+    def put(self, key: str, body: bytes, meta: bytes = b'') -> None:
+        entry = (body, meta)
+        with self.lock:
+            self._insert(key, entry)
+            if self.spill is not None:
+                self.pending[key] = entry
+        if self.spill is not None:
+            self._spill([key])
+
+    def _insert(self, key: str, entry: tuple) -> None:
+        """Keep `entry` in memory and drop the least recently used entries
+        over the budget, called with the lock held.
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[0])
+        if len(entry[0]) > self.max_bytes:
+            # would evict everything else, keep it on disk only
+            return
+
+        self.entries[key] = entry
+        self.bytes += len(entry[0])
+        while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+            _, (evicted_body, _) = self.entries.popitem(last=False)
+            self.bytes -= len(evicted_body)
+            self.evictions += 1
+
+    def _spill(self, keys: list) -> None:
+        """Write the pending entries of `keys` to the store, without holding
+        the lock. A key put again in the meantime is written with its latest
+        version.
+        """
+        with self.spill_lock:
+            for key in keys:
+                with self.lock:
+                    entry = self.pending.get(key)
+                if entry is None:
+                    continue
+                self.spill.put(key, *entry)
+                with self.lock:
+                    if self.pending.get(key) is entry:
+                        del self.pending[key]
+                    self.spills += 1
+
+    def flush(self) -> None:
+        """Write the entries whose write to the store is still outstanding.
+        """
+        if self.spill is None:
+            return
+        with self.lock:
+            keys = list(self.pending)
+        self._spill(keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spills': self.spills,
+            }
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries or key in self.pending or (self.spill is not None and key in self.spill)
+
+
+class SingleFlight:
+    """Make concurrent calls for the same key share one execution, the first
+    caller runs the function and the others wait for its result (or exception).
+    """
+    class Call:
+        def __init__(self) -> None:
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key: str, fn) -> tuple:
+        """Run `fn` unless a call for `key` is already in flight.
+
+        Returns:
+            (result of fn, True if the result came from another caller's call)
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as error:
+                call.error = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def do_background(self, key: str, fn) -> None:
+        """Run `fn` on a background thread unless a call for `key` is already
+        in flight, errors are printed rather than raised.
+        """
+        with self.lock:
+            if key in self.calls:
+                return
+
+        def run():
+            try:
+                self.do(key, fn)
+            except Exception as error:
+                print(f'Background refresh of {key} failed: {error}')
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+
+class OriginPool:
+    """Keep-alive connections to the origin, reused across requests so a miss
+    does not pay for a new TCP connection and TLS handshake.
+
+    Args:
+        origin (str): the origin url, http or https.
+        size (int): maximum number of idle connections kept open.
+        idle_timeout (float): idle connections older than this many seconds are closed.
+        timeout (float): socket timeout of the origin connections.
+    """
+    def __init__(self, origin: str, size: int = 16, idle_timeout: float = 30.0, timeout: float = 30.0) -> None:
+        parsed = urllib.parse.urlsplit(origin)
+        if parsed.scheme == 'https':
+            self.connection_class = http.client.HTTPSConnection
+            self.connection_args = {'context': context}
+        else:
+            self.connection_class = http.client.HTTPConnection
+            self.connection_args = {}
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # (connection, time it was returned), most recently used last
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self) -> tuple:
+        """Return (connection, True if it was reused).
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                connection, released = self.idle.pop()
+                if now - released < self.idle_timeout:
+                    self.reused += 1
+                    return connection, True
+                connection.close()
+            self.created += 1
+        connection = self.connection_class(self.host, self.port, timeout=self.timeout, **self.connection_args)
+        return connection, False
+
+    def release(self, connection) -> None:
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def request(self, url: str, headers: dict) -> 'PooledResponse':
+        """GET the url over a pooled connection. A reused connection which the
+        origin closed in the meantime is retried once on a new connection.
+        """
+        split = urllib.parse.urlsplit(url)
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+
+        while True:
+            connection, reused = self.acquire()
+            try:
+                connection.request('GET', path, headers=headers)
+                return PooledResponse(self, connection, connection.getresponse())
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+            except Exception:
+                connection.close()
+                raise
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'idle': len(self.idle), 'created': self.created, 'reused': self.reused}
+
+    def close(self) -> None:
+        with self.lock:
+            for connection, _ in self.idle:
+                connection.close()
+            self.idle.clear()
+
+
+class PooledResponse:
+    """Wraps a http.client.HTTPResponse and hands the connection back to the
+    pool on close, provided the body was read completely and the origin keeps
+    the connection open.
+    """
+    def __init__(self, pool: OriginPool, connection, response) -> None:
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def getheaders(self) -> list:
+        return self.response.getheaders()
+
+    def read(self, amt: int = None) -> bytes:
+        return self.response.read(amt)
+
+    def read1(self, amt: int = -1) -> bytes:
+        return self.response.read1(amt)
+
+    @property
+    def length(self) -> int:
+        """Bytes of the body still expected per Content-Length, None when the
+        origin sent none.
+        """
+        return self.response.length
+
+    def close(self) -> None:
+        if self.connection is None:
+            return
+        if self.response.length == 0:
+            # eg. a 304, nothing left to read but the response is only marked done after a read
+            self.response.read()
+        if self.response.isclosed() and not self.response.will_close and not self.response.length:
+            self.pool.release(self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+
+    def __enter__(self) -> 'PooledResponse':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class Metrics:
+    """Request counters and the origin latency histogram behind the /__stats and
+    /__metrics endpoints. Every update is a few integer additions under a lock,
+    cheap enough to leave on under load.
+    """
+    # upper bounds in seconds of the origin latency histogram buckets
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    # X-Cache values where the body did not come from the origin for this request
+    FROM_CACHE = ('HIT', 'STALE', 'REVALIDATED', 'COALESCED')
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_flight = 0
+        self.responses = Counter()
+        self.bytes = Counter()
+        self.errors = 0
+        self.origin_requests = 0
+        self.origin_seconds = 0.0
+        # one slot per bucket plus +Inf
+        self.origin_buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def request_started(self) -> None:
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def count_response(self, cache_status: str, size: int) -> None:
+        with self.lock:
+            self.responses[cache_status] += 1
+            self.bytes[cache_status] += size
+
+    def count_error(self) -> None:
+        with self.lock:
+            self.errors += 1
+
+    def observe_origin(self, seconds: float) -> None:
+        bucket = len(self.LATENCY_BUCKETS)
+        for index, bound in enumerate(self.LATENCY_BUCKETS):
+            if seconds <= bound:
+                bucket = index
+                break
+        with self.lock:
+            self.origin_requests += 1
+            self.origin_seconds += seconds
+            self.origin_buckets[bucket] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            total = sum(self.responses.values())
+            from_cache = sum(self.responses[status] for status in self.FROM_CACHE)
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'in_flight': self.in_flight,
+                'responses': dict(self.responses),
+                'errors': self.errors,
+                'hit_ratio': round(from_cache / total, 4) if total else 0.0,
+                'bytes_from_cache': sum(self.bytes[status] for status in self.FROM_CACHE),
+                'bytes_from_origin': self.bytes['MISS'],
+                'origin_requests': self.origin_requests,
+                'origin_latency_avg_ms': round(self.origin_seconds / self.origin_requests * 1000, 2)
+                                         if self.origin_requests else 0.0,
+                'origin_latency_buckets': dict(zip(
+                    [str(bound) for bound in self.LATENCY_BUCKETS] + ['+Inf'], self.origin_buckets
+                )),
+            }
+
+    def prometheus(self, stats: dict) -> str:
+        """Render the stats in the Prometheus text exposition format.
+        """
+        requests = stats['requests']
+        lines = [
+            '# TYPE caching_proxy_in_flight_requests gauge',
+            'caching_proxy_in_flight_requests {}'.format(requests['in_flight']),
+            '# TYPE caching_proxy_responses_total counter',
+        ]
+        lines.extend('caching_proxy_responses_total{{cache="{}"}} {}'.format(status, count)
+                     for status, count in sorted(requests['responses'].items()))
+        lines.extend([
+            '# TYPE caching_proxy_errors_total counter',
+            'caching_proxy_errors_total {}'.format(requests['errors']),
+            '# TYPE caching_proxy_hit_ratio gauge',
+            'caching_proxy_hit_ratio {}'.format(requests['hit_ratio']),
+            '# TYPE caching_proxy_served_bytes_total counter',
+            'caching_proxy_served_bytes_total{{source="cache"}} {}'.format(requests['bytes_from_cache']),
+            'caching_proxy_served_bytes_total{{source="origin"}} {}'.format(requests['bytes_from_origin']),
+            '# TYPE caching_proxy_origin_latency_seconds histogram',
+        ])
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in self.LATENCY_BUCKETS] + ['+Inf'], self.origin_buckets):
+                cumulative += count
+                lines.append('caching_proxy_origin_latency_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+            lines.append('caching_proxy_origin_latency_seconds_sum {}'.format(self.origin_seconds))
+            lines.append('caching_proxy_origin_latency_seconds_count {}'.format(self.origin_requests))
+
+        gauges = [
+            ('caching_proxy_memory_entries', stats['cache']['entries']),
+            ('caching_proxy_memory_bytes', stats['cache']['bytes']),
+            ('caching_proxy_store_entries', stats['store'].get('entries', 0)),
+            ('caching_proxy_store_bytes', stats['store'].get('total_bytes', 0)),
+            ('caching_proxy_store_garbage_bytes', stats['store'].get('dead_bytes', 0)),
+        ]
+        counters = [
+            ('caching_proxy_evictions_total', stats['cache']['evictions']),
+            ('caching_proxy_spills_total', stats['cache']['spills']),
+            ('caching_proxy_origin_connections_created_total', stats['origin_pool']['created']),
+            ('caching_proxy_origin_connections_reused_total', stats['origin_pool']['reused']),
+        ]
+        for name, value in gauges:
+            lines.extend(['# TYPE {} gauge'.format(name), '{} {}'.format(name, value)])
+        for name, value in counters:
+            lines.extend(['# TYPE {} counter'.format(name), '{} {}'.format(name, value)])
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """Statistical profiler which can be switched on and off while the proxy is
+    running. A background thread samples the stack of every other thread each
+    `interval` seconds, so the overhead is bounded by the sampling rate and is
+    zero while stopped.
+
+    Args:
+        interval (float): seconds between samples.
+    """
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = threading.Event()
+        self.samples = 0
+        # function -> samples where it was running / anywhere on the stack
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.running.clear()
+            thread.join()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.samples = 0
+            self.self_counts.clear()
+            self.total_counts.clear()
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while self.running.is_set():
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    self.samples += 1
+                    self.self_counts[self.describe(frame)] += 1
+                    seen = set()
+                    while frame is not None:
+                        name = self.describe(frame)
+                        if name not in seen:
+                            seen.add(name)
+                            self.total_counts[name] += 1
+                        frame = frame.f_back
+            time.sleep(self.interval)
+
+    @staticmethod
+    def describe(frame) -> str:
+        code = frame.f_code
+        return '{}:{}({})'.format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+    def report(self, top: int = 25) -> str:
+        with self.lock:
+            samples = self.samples or 1
+            lines = ['running: {}, samples: {}'.format(self.thread is not None, self.samples), '',
+                     '{:>7} {:>7}  function'.format('self%', 'total%')]
+            for name, count in self.total_counts.most_common(top):
+                lines.append('{:>7.1f} {:>7.1f}  {}'.format(
+                    self.self_counts[name] * 100 / samples, count * 100 / samples, name
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def control(self, query: dict) -> str:
+        """Handle /__profile?action=start|stop|reset, without an action the
+        report is returned.
+
+        Raises:
+            ValueError: `top` is not a positive number.
+        """
+        top = query.get('top', ['25'])[0]
+        if not top.isdigit() or int(top) < 1:
+            raise ValueError(f'top must be a positive number, not {top!r}')
+        action = query.get('action', [''])[0]
+        if action == 'start':
+            self.start()
+        elif action == 'stop':
+            self.stop()
+        elif action == 'reset':
+            self.reset()
+        return self.report(int(top))
+
+
+METRICS = Metrics()
+PROFILER = SamplingProfiler()
+
+
+def import_legacy_cache(store: CacheStore) -> None:
+    """Move the entries of a cache.pkl written by older versions into the store.
+    """
+    if not os.path.exists(LEGACY_CACHE_FILE):
+        return
+    with open(LEGACY_CACHE_FILE, 'rb') as f:
+        legacy = pickle.load(f)
+    for url, content in legacy.items():
+        store.put(url, content)
+    os.unlink(LEGACY_CACHE_FILE)
+    print(f'Imported {len(legacy)} entries from {LEGACY_CACHE_FILE}')
+
+
+def parse_cache_control(value: str) -> dict:
+    """Split a Cache-Control header into {directive: argument}, directives
+    without an argument map to None.
+    """
+    directives = {}
+    for part in value.split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def http_date(value: str) -> float:
+    """Convert an HTTP date header into a timestamp, None if missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers: dict, now: float) -> float:
+    """Work out for how many seconds a response stays fresh.
+
+    Args:
+        headers (dict): the response headers with lower case names.
+        now (float): timestamp the response was received.
+
+    Returns:
+        the lifetime in seconds, None if the response must not be stored.
+    """
+    cache_control = parse_cache_control(headers.get('cache-control', ''))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            try:
+                return max(0, int(cache_control[directive]))
+            except (TypeError, ValueError):
+                return 0
+
+    date = http_date(headers.get('date')) or now
+    if 'expires' in headers:
+        expires = http_date(headers['expires'])
+        # an invalid Expires means already expired
+        return max(0, expires - date) if expires is not None else 0
+
+    last_modified = http_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return min(MAX_HEURISTIC_TTL, max(0, (date - last_modified) / 10))
+    return DEFAULT_TTL
+
+
+def variant_key(url: str, vary: list, request_headers) -> str:
+    """Build the cache key of the variant selected by the request headers named
+    in the origin's Vary header.
+    """
+    selected = '\n'.join('{}={}'.format(name, request_headers.get(name, '')) for name in vary)
+    return f'{url}\n{selected}'
+
+
+def build_meta(status: int, headers: list, now: float, request_headers=None) -> dict:
+    """Collect what needs to be stored next to a response body, None if the
+    response may not be cached.
+
+    Args:
+        status (int): the origin status code.
+        headers (list): the origin response headers as (name, value) pairs.
+        now (float): timestamp the response was received.
+        request_headers: headers of the client request the response answers, if any.
+    """
+    if status not in CACHEABLE_STATUS:
+        return None
+    headers = [(name, value) for name, value in headers if name.lower() not in NOT_FORWARDED]
+    lookup = {name.lower(): value for name, value in headers}
+    cache_control = parse_cache_control(lookup.get('cache-control', ''))
+    if 'set-cookie' in lookup:
+        return None
+    if request_headers is not None and any(name in request_headers for name in CREDENTIALS):
+        # RFC 9111 3.5, the response may depend on who asked for it
+        if not ('public' in cache_control or 's-maxage' in cache_control or 'must-revalidate' in cache_control):
+            return None
+    lifetime = freshness_lifetime(lookup, now)
+    if lifetime is None:
+        return None
+    try:
+        # time the response already spent in caches upstream
+        age = max(0, int(lookup.get('age', 0)))
+    except ValueError:
+        age = 0
+    lifetime = max(0, lifetime - age)
+    if lifetime == 0 and 'etag' not in lookup and 'last-modified' not in lookup:
+        # stale straight away and nothing to revalidate with
+        return None
+
+    try:
+        swr = int(cache_control.get('stale-while-revalidate') or 0)
+    except ValueError:
+        swr = 0
+    vary = [name.strip().lower() for name in lookup.get('vary', '').split(',') if name.strip()]
+    if '*' in vary:
+        return None
+    if COMPRESS_LEVEL:
+        # the encoding is negotiated by the proxy, not stored per variant
+        vary = [name for name in vary if name != 'accept-encoding']
+    return {
+        'status': status,
+        'headers': [[name, value] for name, value in headers if name.lower() not in NOT_STORED | {'age'}],
+        'stored': now,
+        'age': age,
+        'expires': now + lifetime,
+        'swr': swr,
+        'vary': vary,
+    }
+
+
+def revalidated_meta(meta: dict, headers: list, now: float) -> dict:
+    """Merge the headers of a 304 Not Modified into the stored meta and
+    recalculate the freshness.
+    """
+    updated = {name.lower(): value for name, value in headers if name.lower() not in NOT_FORWARDED}
+    merged = [[name, value] for name, value in meta['headers'] if name.lower() not in updated]
+    merged.extend([name, value] for name, value in headers if name.lower() in updated and name.lower() != 'age')
+    refreshed = build_meta(meta['status'], merged, now)
+    if refreshed is None:
+        # the origin confirmed the body, keep it even if it is now stale straight away
+        return dict(meta, stored=now, age=0, expires=now)
+    if 'encoding' in meta:
+        # the stored body is still the compressed one
+        refreshed['encoding'] = meta['encoding']
+    return refreshed
+
+
+def compress_entry(body: bytes, meta: dict) -> tuple:
+    """Gzip compress a body before it is stored, when compression is enabled and
+    the origin sent an uncompressed textual response.
+
+    Returns:
+        (body, meta), meta['encoding'] is 'gzip' if the body was compressed.
+    """
+    if not COMPRESS_LEVEL or meta['status'] != 200 or len(body) < MIN_COMPRESS_SIZE:
+        return body, meta
+    headers = {name.lower(): value for name, value in meta['headers']}
+    if 'content-encoding' in headers or not headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES):
+        return body, meta
+    # wbits 31 writes the gzip container, so the bytes can be sent as Content-Encoding: gzip
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) >= len(body):
+        return body, meta
+    return compressed, dict(meta, encoding='gzip')
+
+
+def accepts_gzip(value: str) -> bool:
+    """Check an Accept-Encoding header for gzip (or *) with a non zero q value.
+    """
+    accepted = {}
+    for part in value.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, argument = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(argument)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.strip().lower()] = q
+    return accepted.get('gzip', accepted.get('*', 0)) > 0
+
+
+def weak_etag(value: str) -> str:
+    return value if value.startswith('W/') else 'W/' + value
+
+
+def store_response(url: str, key: str, content: bytes, meta: dict, request_headers) -> None:
+    """Put an origin response into the cache under its (variant) key.
+    """
+    if meta['vary']:
+        # the plain url only remembers which request headers select the variant
+        CACHE.put(url, b'', json.dumps({'vary': meta['vary']}).encode())
+        key = variant_key(url, meta['vary'], request_headers)
+    stored_content, stored_meta = compress_entry(content, meta)
+    CACHE.put(key, stored_content, json.dumps(stored_meta).encode())
+
+
+def parse_range(value: str, size: int):
+    """Parse a single byte range Range header against a body of `size` bytes.
+
+    Returns:
+        (start, end) with end exclusive, None to ignore the header and send the
+        whole body, or 'unsatisfiable' when the range lies outside the body.
+    """
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    first, _, last = value[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix == 0:
+                return 'unsatisfiable'
+            return max(0, size - suffix), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return 'unsatisfiable'
+    return start, min(end, size)
+
+
+def has_no_body(status: int) -> bool:
+    return status < 200 or status in NO_BODY_STATUS
+
+
+def if_range_matches(value: str, stored: dict) -> bool:
+    """Check an If-Range header against the stored response headers (lower
+    case names). An ETag must match the stored one with the strong comparison,
+    a date must equal the stored Last-Modified. Without the header the Range
+    always applies.
+    """
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith(('"', 'W/')):
+        etag = stored.get('etag', '')
+        return not value.startswith('W/') and not etag.startswith('W/') and value == etag
+    last_modified = http_date(stored.get('last-modified'))
+    return last_modified is not None and http_date(value) == last_modified
 
 
 class Handler(http.server.SimpleHTTPRequestHandler):
@@ -37,57 +1132,571 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         http (SimpleHTTPRequestHandler)): the parent class with access to methods for
         handling http.
     """
+    # HTTP/1.1 keeps client connections open between requests, an idle client
+    # connection is closed after `timeout` seconds so it frees its worker. The
+    # pooled server only lets a few connections wait like that, see end_headers
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+    # headers and body are written separately, don't let Nagle hold back the body
+    disable_nagle_algorithm = True
+    # holding one of the server's keep_alive_slots
+    keep_alive_slot = False
+
+    def end_headers(self):
+        """Keep the connection open after this response only if a keep-alive
+        slot of the server is free, otherwise tell the client it is closed.
+        """
+        slots = getattr(self.server, 'keep_alive_slots', None)
+        if slots is not None and not self.close_connection and not self.keep_alive_slot:
+            if slots.acquire(blocking=False):
+                self.keep_alive_slot = True
+            else:
+                self.send_header('Connection', 'close')
+        super().end_headers()
+
+    def parse_request(self):
+        # the next request arrived, the connection is no longer idle
+        self.release_keep_alive()
+        return super().parse_request()
+
+    def finish(self):
+        self.release_keep_alive()
+        super().finish()
+
+    def release_keep_alive(self) -> None:
+        if self.keep_alive_slot:
+            self.keep_alive_slot = False
+            self.server.keep_alive_slots.release()
+
     def do_GET(self):
         """This method handles the GET request by checking if the url exists
-        within the cache, if yes then the response is returned from the cache.
-        If not, the origin url is opened and stored in the cache and a 301(redirect)
-        response code is returned.
+        within the cache, if yes and the entry is still fresh then the response
+        is returned from the cache. A stale entry is revalidated with the origin
+        using its ETag/Last-Modified, so an unchanged body costs a 304 round trip
+        only. Otherwise the origin url is opened, returned with its own status
+        code and headers and stored in the cache when the origin allows it.
+
+        Concurrent requests for the same key share a single origin fetch, and
+        within the stale-while-revalidate window a stale entry is served as is
+        while it is refreshed in the background.
         """
         parsed_url = urllib.parse.urlparse(self.path)
-        url = ORIGIN + parsed_url.geturl()
+        if parsed_url.path == STATS_PATH:
+            self.send_internal(json.dumps(self.stats(), indent=2), 'application/json')
+            return
+        if parsed_url.path == METRICS_PATH:
+            self.send_internal(METRICS.prometheus(self.stats()), 'text/plain; version=0.0.4')
+            return
+        if parsed_url.path == PROFILE_PATH:
+            try:
+                report = PROFILER.control(urllib.parse.parse_qs(parsed_url.query))
+            except ValueError as error:
+                self.send_error(400, str(error))
+                return
+            self.send_internal(report, 'text/plain')
+            return
+
+        METRICS.request_started()
+        try:
+            self.serve(ORIGIN + parsed_url.geturl())
+        finally:
+            METRICS.request_finished()
+
+    def serve(self, url: str) -> None:
+        """Answer the request for `url` from the cache or the origin.
+        """
+        now = time.time()
+        self.head_sent = False
 
         #set_trace()
-        if url in CACHE:
-            self.send_response(200)
-            self.send_header('X-Cache', 'HIT')
-            self.end_headers()
-            self.wfile.write(CACHE[url])
+        key = self.cache_key(url)
+        cached = CACHE.get_entry(key)
+        # entries written before meta was stored have none and are fetched again
+        meta = json.loads(cached[1]) if cached and cached[1] else None
+        if meta and meta['expires'] > now:
+            self.send_entry(meta, cached[0], 'HIT', now)
+            return
+
+        if meta and meta['expires'] + max(STALE_WHILE_REVALIDATE, meta.get('swr', 0)) > now:
+            # the handler moves on to the next request of the connection while the refresh runs
+            request_headers = copy.deepcopy(self.headers)
+            FLIGHTS.do_background(key, lambda: self.refresh(url, key, cached, meta, now, request_headers))
+            self.send_entry(meta, cached[0], 'STALE', now)
+            return
+
+        try:
+            (shared_meta, body, cache_status, sent), shared = FLIGHTS.do(
+                key, lambda: self.refresh(url, key, cached, meta, now, stream=True))
+            if sent and not shared:
+                return
+            if body is None:
+                # the shared response was too large to keep in memory or may not be stored, in which case
+                # it was meant for the client of the first request only, fetch our own copy
+                self.refresh(url, key, cached, meta, now, stream=True)
+                return
+            if shared and shared_meta.get('vary'):
+                # the flight ran under the bare url before the origin's Vary was known, the first request
+                # may have selected another variant than this one
+                variant = variant_key(url, shared_meta['vary'], self.headers)
+                if variant != key:
+                    self.refresh(url, variant, None, None, now, stream=True)
+                    return
+            self.send_entry(shared_meta, body, 'COALESCED' if shared else cache_status, time.time())
+        except (OSError, http.client.HTTPException) as error:
+            METRICS.count_error()
+            self.fail(500, f'Error fetching {url}: {error}')
+        except Exception as error:
+            METRICS.count_error()
+            self.fail(500, f'Unexpexted error: {error}')
+
+    def fail(self, code: int, message: str) -> None:
+        """Answer with an error status, or if the status line and headers of
+        a response already went out, drop the connection so the client sees an
+        incomplete response rather than an error page glued to it.
+        """
+        if self.head_sent:
+            self.log_error('%s', message)
+            self.close_connection = True
         else:
+            self.send_error(code, message)
+
+    def refresh(self, url: str, key: str, cached: tuple, meta: dict, now: float,
+                request_headers=None, stream: bool = False) -> tuple:
+        """Fetch the url from the origin (conditionally if there is a stored
+        entry) and update the cache with the result. With `stream` the origin
+        body is forwarded to the client as it arrives instead of after the
+        download completed. `request_headers` defaults to the headers of the
+        request being handled.
+
+        Returns:
+            (meta, body, X-Cache value, True if the response was already sent to
+            the client), body is None when it exceeded the max cacheable size or
+            the response may not be stored.
+        """
+        if request_headers is None:
+            request_headers = self.headers
+        status, headers, response = self.fetch(url, request_headers, meta)
+        with response:
+            if status == 304 and meta:
+                meta = revalidated_meta(meta, headers, now)
+                CACHE.put(key, cached[0], json.dumps(meta).encode())
+                return meta, cached[0], 'REVALIDATED', False
+
+            new_meta = build_meta(status, headers, now, request_headers)
+            response_meta = new_meta or {'status': status, 'headers': headers, 'stored': now, 'age': 0}
+            if stream:
+                content = self.stream_response(response_meta, response, 'MISS', now)
+            else:
+                content = response.read(MAX_CACHEABLE_SIZE + 1)
+                if len(content) > MAX_CACHEABLE_SIZE or response.length:
+                    # too large to keep, or the origin closed before the end of the body
+                    content = None
+
+        if content is None or new_meta is None:
+            return response_meta, None, 'MISS', stream
+
+        store_response(url, key, content, new_meta, request_headers)
+        return new_meta, content, 'MISS', stream
+
+    def cache_key(self, url: str) -> str:
+        """Return the key of the cached variant matching this request.
+        """
+        meta = CACHE.get_meta(url)
+        if meta:
+            vary = json.loads(meta).get('vary')
+            if vary:
+                return variant_key(url, vary, self.headers)
+        return url
+
+    def fetch(self, url: str, request_headers, meta: dict = None) -> tuple:
+        """Request the url from the origin, conditionally if a stored entry is
+        being revalidated.
+
+        Returns:
+            (status code, list of (header, value), response), the caller reads
+            the body from the response and closes it.
+        """
+        headers = {name: value for name, value in request_headers.items() if name.lower() not in NOT_FORWARDED}
+        if COMPRESS_LEVEL:
+            # the proxy compresses itself, ask the origin for the plain body
+            headers = {name: value for name, value in headers.items() if name.lower() != 'accept-encoding'}
+        if meta:
+            stored = {name.lower(): value for name, value in meta['headers']}
+            if 'etag' in stored:
+                headers['If-None-Match'] = stored['etag']
+            if 'last-modified' in stored:
+                headers['If-Modified-Since'] = stored['last-modified']
+
+        start = time.perf_counter()
+        try:
+            response = ORIGIN_POOL.request(url, headers)
+        finally:
+            METRICS.observe_origin(time.perf_counter() - start)
+        return response.status, response.getheaders(), response
+
+    def send_entry(self, meta: dict, body: bytes, cache_status: str, now: float) -> None:
+        """Write a response with the stored status and headers to the client.
+        A compressed body is sent as is to clients accepting gzip and
+        decompressed for the others. A single Range of a stored 200 is answered
+        with a 206 sliced out of the body through a memoryview, so the body is
+        never copied, unless an If-Range shows the client holds another version.
+        """
+        stored = {name.lower(): value for name, value in meta['headers']}
+        extra = []
+        if cache_status != 'MISS' and meta['status'] == 200 and 'etag' in stored:
+            # If-None-Match uses the weak comparison, W/ prefixes are ignored
+            etag = stored['etag'].replace('W/', '', 1)
+            requested = (tag.strip().replace('W/', '', 1) for tag in self.headers.get('If-None-Match', '').split(','))
+            if etag in requested:
+                self.send_head(dict(meta, status=304), cache_status, now, None)
+                METRICS.count_response(cache_status, 0)
+                return
+
+        send_compressed = False
+        if meta.get('encoding') == 'gzip':
+            extra.append(('Vary', 'Accept-Encoding'))
+            send_compressed = accepts_gzip(self.headers.get('Accept-Encoding', '')) and 'Range' not in self.headers
+            if send_compressed:
+                extra.append(('Content-Encoding', 'gzip'))
+                # the compressed bytes are a different representation than the origin's
+                meta = dict(meta, headers=[
+                    [name, weak_etag(value) if name.lower() == 'etag' else value] for name, value in meta['headers']
+                ])
+            else:
+                body = zlib.decompress(body, 31)
+
+        if cache_status != 'MISS' and meta['status'] == 200 and not send_compressed:
+            byte_range = None
+            if if_range_matches(self.headers.get('If-Range'), stored):
+                byte_range = parse_range(self.headers.get('Range'), len(body))
+            if byte_range == 'unsatisfiable':
+                self.send_head(dict(meta, status=416, headers=[]), cache_status, now, 0,
+                               [('Content-Range', f'bytes */{len(body)}')])
+                METRICS.count_response(cache_status, 0)
+                return
+            if byte_range:
+                start, end = byte_range
+                extra.append(('Content-Range', f'bytes {start}-{end - 1}/{len(body)}'))
+                meta = dict(meta, status=206)
+                body = memoryview(body)[start:end]
+
+        self.send_head(meta, cache_status, now, len(body), extra)
+        self.wfile.write(body)
+        METRICS.count_response(cache_status, len(body))
+
+    def send_head(self, meta: dict, cache_status: str, now: float, content_length, extra: list = ()) -> None:
+        """Write the status line and headers of a response, without Content-Length
+        when `content_length` is None or the status has no body.
+        """
+        self.head_sent = True
+        self.send_response(meta['status'])
+        for name, value in meta['headers']:
+            # send_response already wrote our own Server and Date
+            if name.lower() not in NOT_FORWARDED and name.lower() not in NOT_STORED and name.lower() != 'age':
+                self.send_header(name, value)
+        for name, value in extra:
+            self.send_header(name, value)
+        self.send_header('Age', str(int(meta['age'] + now - meta['stored'])))
+        if content_length is not None and not has_no_body(meta['status']):
+            self.send_header('Content-Length', str(content_length))
+        self.send_header('X-Cache', cache_status)
+        self.end_headers()
+
+    def stream_response(self, meta: dict, response, cache_status: str, now: float) -> bytes:
+        """Forward the origin body to the client chunk by chunk while keeping a
+        copy for the cache. Once the body grows past MAX_CACHEABLE_SIZE the copy
+        is dropped and the rest is only passed through. If the client goes away
+        the download carries on as long as the body is still being kept. A body
+        cut short by the origin is not cached and the client connection is
+        closed without terminating it, so the client notices as well.
+
+        Returns:
+            the complete body, None if it was too large to keep or incomplete.
+        """
+        if has_no_body(meta['status']):
+            self.send_head(meta, cache_status, now, None)
+            METRICS.count_response(cache_status, 0)
+            return b''
+
+        # without a Content-Length from the origin the body is sent chunked to
+        # HTTP/1.1 clients, HTTP/1.0 clients see the end when the connection closes
+        content_length = response.headers.get('Content-Length')
+        chunked = content_length is None and self.protocol_version == self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.send_head(meta, cache_status, now, None, [('Transfer-Encoding', 'chunked')])
+        else:
+            if content_length is None:
+                self.close_connection = True
+            self.send_head(meta, cache_status, now, content_length)
+
+        # read1 returns whatever has arrived instead of waiting for a full chunk
+        read = getattr(response, 'read1', response.read)
+        chunks = []
+        size = 0
+        streamed = 0
+        keep = True
+        client_connected = True
+        complete = True
+        while client_connected or keep:
             try:
-                with urllib.request.urlopen(url, context=context) as response:
-                    content = response.read()
-                    CACHE[url] = content
-
-                    self.send_response(301)
-                    self.send_header('X-Cache', 'MISS')
-                    self.end_headers()
-                    self.wfile.write(CACHE[url])
-
-                    with open(CACHE_FILE, 'wb') as f:
-                        pickle.dump(CACHE, f)
-            except urllib.error.URLError as error:
-                self.send_error(500, f'Error fetching {url}: {error.reason}')
-            except Exception as error:
-                self.send_error(500, f'Unexpexted error: {error}')
+                chunk = read(CHUNK_SIZE)
+            except http.client.IncompleteRead:
+                # a chunked body ending early
+                complete = False
+                break
+            if not chunk:
+                # an empty read is also what a Content-Length body ending early looks like
+                complete = not response.length
+                break
+            if client_connected:
+                try:
+                    if chunked:
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    else:
+                        self.wfile.write(chunk)
+                    streamed += len(chunk)
+                except OSError:
+                    # gone, or stopped reading until the write timed out, keep reading for the cache copy
+                    client_connected = False
+            if keep:
+                size += len(chunk)
+                if size > MAX_CACHEABLE_SIZE:
+                    keep = False
+                    chunks = []
+                else:
+                    chunks.append(chunk)
 
+        if client_connected and complete and chunked:
+            try:
+                self.wfile.write(b'0\r\n\r\n')
+            except OSError:
+                client_connected = False
+        if not client_connected or not complete:
+            self.close_connection = True
+        METRICS.count_response(cache_status, streamed)
+        return b''.join(chunks) if keep and complete else None
 
-def clear_cache():
+    def stats(self) -> dict:
+        return {
+            'requests': METRICS.snapshot(),
+            'cache': CACHE.stats(),
+            'store': CACHE.spill.stats() if CACHE.spill is not None else {},
+            'origin_pool': ORIGIN_POOL.stats(),
+            'flights_in_progress': len(FLIGHTS),
+        }
+
+    def send_internal(self, text: str, content_type: str) -> None:
+        """Answer one of the proxy's own endpoints, never cached.
+        """
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadPoolTCPServer(socketserver.TCPServer):
+    """A TCPServer which hands every accepted connection to a bounded pool of
+    worker threads, so one slow origin fetch does not block the other clients.
+
+    A worker stays with its connection while a keep-alive client is idle, so
+    only `keep_alive` connections at a time are kept open between requests, the
+    others are closed after their response. This leaves workers free for new
+    connections however many clients sit idle.
+
+    Args:
+        workers (int): the maximum number of requests handled at the same time.
+        keep_alive (int): connections kept open between requests, a quarter of
+            the workers by default.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, RequestHandlerClass, workers: int = 16, keep_alive: int = None) -> None:
+        # Created before binding so server_close can shut it down when the bind fails
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='proxy-worker')
+        if keep_alive is None:
+            keep_alive = workers // 4
+        self.keep_alive_slots = threading.BoundedSemaphore(keep_alive)
+        super().__init__(server_address, RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """Same as socketserver.ThreadingMixIn.process_request_thread but run
+        on a pooled worker.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        # TCPServer.__init__ calls server_close when binding fails
+        executor = getattr(self, 'executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleConnectionHandler(Handler):
+    """Handler for the single-threaded server, which closes the connection after
+    every response since an idle keep-alive client would block all others.
+    """
+    protocol_version = 'HTTP/1.0'
+
+
+def read_warm_paths(path: str) -> list:
+    """Read the paths to prefetch from a file holding either one url or path per
+    line, or an access log in common/combined log format. Paths requested more
+    often come first.
+    """
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = ACCESS_LOG_REQUEST.search(line)
+            if match:
+                target = match.group(1)
+            else:
+                target = line.split()[0]
+            if target.startswith(('http://', 'https://')):
+                split = urllib.parse.urlsplit(target)
+                target = split.path + ('?' + split.query if split.query else '')
+            if target.startswith('/'):
+                counts[target] += 1
+    return [target for target, _ in counts.most_common()]
+
+
+class RateLimiter:
+    """Spread calls evenly at `rate` per second across all threads, 0 for no limit.
+    """
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def warm_cache(paths: list, concurrency: int = 8, rate: float = 0) -> None:
+    """Prefetch the paths from the origin into the cache, skipping those which
+    are already cached and fresh. Fetches go through the single flight group, so
+    warming while serving does not duplicate a client's miss of the same url.
+
+    Args:
+        paths (list): the paths to fetch, relative to the origin.
+        concurrency (int): origin fetches running at the same time.
+        rate (float): maximum fetches per second, 0 for no limit.
+    """
+    limiter = RateLimiter(rate)
+    lock = threading.Lock()
+    progress = Counter()
+    start = time.monotonic()
+    last_report = [start]
+
+    def warm(path):
+        url = ORIGIN + path
+        meta = CACHE.get_meta(url)
+        if meta and json.loads(meta).get('expires', 0) > time.time():
+            outcome, size = 'skipped', 0
+        else:
+            limiter.wait()
+            try:
+                # same result shape as Handler.refresh, so either can join the other's flight
+                (meta, body, _, _), _ = FLIGHTS.do(url, lambda: prefetch(url))
+                outcome = 'cached' if body is not None and 'expires' in meta else 'uncacheable'
+                size = len(body) if body is not None else 0
+            except (OSError, http.client.HTTPException) as error:
+                print(f'Warm-up of {path} failed: {error}')
+                outcome, size = 'errors', 0
+
+        with lock:
+            progress[outcome] += 1
+            progress['bytes'] += size
+            now = time.monotonic()
+            done = progress['cached'] + progress['uncacheable'] + progress['skipped'] + progress['errors']
+            if now - last_report[0] >= 1 or done == len(paths):
+                last_report[0] = now
+                elapsed = now - start
+                print('Warm-up {}/{} ({:.0%}): {} cached, {} skipped, {} uncacheable, {} errors, '
+                      '{:.1f} req/s, {:.2f} MB/s'.format(
+                          done, len(paths), done / len(paths), progress['cached'], progress['skipped'],
+                          progress['uncacheable'], progress['errors'], done / elapsed,
+                          progress['bytes'] / elapsed / 1024 / 1024))
+
+    def prefetch(url):
+        start_fetch = time.perf_counter()
+        try:
+            response = ORIGIN_POOL.request(url, {})
+        finally:
+            METRICS.observe_origin(time.perf_counter() - start_fetch)
+        now = time.time()
+        with response:
+            status, headers = response.status, response.getheaders()
+            content = response.read(MAX_CACHEABLE_SIZE + 1)
+        if len(content) > MAX_CACHEABLE_SIZE:
+            content = None
+        meta = build_meta(status, headers, now)
+        if meta is None or content is None:
+            return {'status': status, 'headers': headers, 'stored': now, 'age': 0}, content, 'MISS', False
+        store_response(url, url, content, meta, {})
+        return meta, content, 'MISS', False
+
+    if not paths:
+        print('Warm-up: nothing to fetch')
+        return
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='warm-up') as pool:
+        list(pool.map(warm, paths))
+
+
+def clear_cache(cache_dir: str = CACHE_DIR):
     """Remove the cache from disk.
+
+    Args:
+        cache_dir (str): directory of the on-disk cache store.
     """
-    if os.path.exists(CACHE_FILE):
-            os.unlink(CACHE_FILE)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    if os.path.exists(LEGACY_CACHE_FILE):
+        os.unlink(LEGACY_CACHE_FILE)
     print('Cache removed')
     sys.exit(0)
 
-def caching_proxy(host: str, port: int) -> None:
+def caching_proxy(host: str, port: int, threaded: bool = False, workers: int = 16, keep_alive: int = None) -> None:
     """This starts the server on the specified interface and port.
 
     Args:
         host (str): the interface which the server with listen on.
         port (int): the traffic port used by the server.
+        threaded (bool): serve requests concurrently from a pool of worker threads.
+        workers (int): size of the worker pool when threaded.
+        keep_alive (int): client connections kept open between requests when threaded.
     """
-    with socketserver.TCPServer((host, port), Handler) as httpd:
-        print(f'Server listening on port {port}. Ctrl+C to quit.')
+    if threaded:
+        server = ThreadPoolTCPServer((host, port), Handler, workers=workers, keep_alive=keep_alive)
+        mode = f'{workers} workers'
+    else:
+        server = socketserver.TCPServer((host, port), SingleConnectionHandler)
+        mode = 'single-threaded'
+
+    with server as httpd:
+        print(f'Server listening on port {port} ({mode}). Ctrl+C to quit.')
         httpd.serve_forever()
 
 
@@ -101,13 +1710,57 @@ if __name__ == '__main__':
     parser.add_argument('--port', help='listening port', type=int, default=8080)
     parser.add_argument('--origin', help='original traffic destination')
     parser.add_argument('--clear-cache', action='store_true', help='clear the cached data')
+    parser.add_argument('--threaded', action='store_true', help='serve requests concurrently')
+    parser.add_argument('--workers', help='worker threads when --threaded', type=int, default=16)
+    parser.add_argument('--keep-alive', help='client connections kept open between requests when --threaded, '
+                        'each one ties up a worker while idle (default: a quarter of --workers)', type=int)
+    parser.add_argument('--cache-dir', help='directory of the on-disk cache store', default=CACHE_DIR)
+    parser.add_argument('--memory-mb', help='memory budget of the cache in MB', type=int, default=256)
+    parser.add_argument('--memory-entries', help='maximum entries held in memory', type=int, default=10000)
+    parser.add_argument('--stale-while-revalidate', help='seconds a stale entry is served while refreshing',
+                        type=int, default=STALE_WHILE_REVALIDATE)
+    parser.add_argument('--max-cacheable-mb', help='larger responses are streamed but not cached',
+                        type=int, default=MAX_CACHEABLE_SIZE // (1024 * 1024))
+    parser.add_argument('--pool-size', help='idle keep-alive connections kept to the origin', type=int, default=16)
+    parser.add_argument('--pool-idle-timeout', help='seconds an idle origin connection is kept',
+                        type=float, default=30.0)
+    parser.add_argument('--compress-level', help='store textual bodies gzip compressed at this zlib level (1-9)',
+                        type=int, default=COMPRESS_LEVEL, choices=range(0, 10))
+    parser.add_argument('--profile', action='store_true', help='start the sampling profiler, see /__profile')
+    parser.add_argument('--warm', help='prefetch the urls or paths in this file, or in an access log, into the cache')
+    parser.add_argument('--warm-concurrency', help='parallel origin fetches while warming', type=int, default=8)
+    parser.add_argument('--warm-rate', help='maximum origin fetches per second while warming, 0 for no limit',
+                        type=float, default=0)
+    parser.add_argument('--warm-background', action='store_true',
+                        help='accept connections while warming instead of warming first')
+    parser.add_argument('--default-ttl', help='seconds a response without caching headers stays fresh',
+                        type=int, default=DEFAULT_TTL)
     args = parser.parse_args()
 
     if args.clear_cache:
-        clear_cache()
+        clear_cache(args.cache_dir)
 
 
     PORT = args.port
     ORIGIN = args.origin
+    DEFAULT_TTL = args.default_ttl
+    STALE_WHILE_REVALIDATE = args.stale_while_revalidate
+    FLIGHTS = SingleFlight()
+    ORIGIN_POOL = OriginPool(ORIGIN, args.pool_size, args.pool_idle_timeout)
+    MAX_CACHEABLE_SIZE = args.max_cacheable_mb * 1024 * 1024
+    COMPRESS_LEVEL = args.compress_level
+    if args.profile:
+        PROFILER.start()
+    store = CacheStore(args.cache_dir)
+    import_legacy_cache(store)
+    CACHE = LRUCache(args.memory_mb * 1024 * 1024, args.memory_entries, spill=store)
+
+    if args.warm:
+        warm_paths = read_warm_paths(args.warm)
+        warm_args = (warm_paths, args.warm_concurrency, args.warm_rate)
+        if args.warm_background:
+            threading.Thread(target=warm_cache, args=warm_args, name='warm-up', daemon=True).start()
+        else:
+            warm_cache(*warm_args)
 
-    caching_proxy('', PORT)
+    caching_proxy('', PORT, threaded=args.threaded, workers=args.workers, keep_alive=args.keep_alive)
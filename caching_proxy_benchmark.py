@@ -0,0 +1,203 @@
+import argparse
+import http.client
+import http.server
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'caching_proxy.py')
+
+
+def free_port() -> int:
+    """Ask the OS for an unused local port.
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def text_body(size: int) -> bytes:
+    """Generate `size` bytes of html-like text which compresses about as well as
+    a real page.
+    """
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(2, 9)))
+             for _ in range(500)]
+    parts = []
+    length = 0
+    while length < size:
+        part = '<p class="item">{}</p>\n'.format(' '.join(random.choices(words, k=12)))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts).encode()[:size]
+
+
+def stub_origin(port: int, delay: float, body_size: int, text: bool = False) -> http.server.ThreadingHTTPServer:
+    """Start a local origin which answers every GET after `delay` seconds with
+    `body_size` bytes.
+
+    Args:
+        port (int): the port the stub origin listens on.
+        delay (float): seconds to sleep before answering, simulates a slow origin.
+        body_size (int): size of the response body in bytes.
+        text (bool): serve compressible text/html instead of random bytes.
+    """
+    body = text_body(body_size) if text else os.urandom(body_size)
+    content_type = 'text/html' if text else 'application/octet-stream'
+
+    class StubHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class StubServer(http.server.ThreadingHTTPServer):
+        # the default backlog of 5 drops connections when the proxy opens many at once
+        request_queue_size = 128
+
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Nothing listening on port {port}')
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_load(proxy_port: int, requests: int, concurrency: int, paths: int, keep_alive: bool = True,
+             gzip: bool = False) -> tuple:
+    """Fire `requests` GETs spread over `paths` distinct urls at the proxy.
+
+    Args:
+        keep_alive (bool): every client reuses one HTTP/1.1 connection instead of
+            connecting per request.
+        gzip (bool): send Accept-Encoding: gzip.
+
+    Returns:
+        (elapsed seconds, list of per request latencies, number of failed requests,
+        body bytes received)
+    """
+    paths = [f'/item/{random.randrange(paths)}' for _ in range(requests)]
+    local = threading.local()
+    headers = {}
+    if not keep_alive:
+        headers['Connection'] = 'close'
+    if gzip:
+        headers['Accept-Encoding'] = 'gzip'
+
+    def fetch(path):
+        start = time.perf_counter()
+        received = 0
+        for attempt in range(2):
+            connection = getattr(local, 'connection', None)
+            if connection is None:
+                connection = local.connection = http.client.HTTPConnection('127.0.0.1', proxy_port, timeout=30)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                received = len(response.read())
+                ok = response.status < 500
+                if response.will_close:
+                    connection.close()
+                    local.connection = None
+                break
+            except Exception:
+                # the proxy may have closed an idle keep-alive connection, retry once
+                connection.close()
+                local.connection = None
+                ok = False
+        return time.perf_counter() - start, ok, received
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, paths))
+    elapsed = time.perf_counter() - start
+    return elapsed, [r[0] for r in results], sum(1 for r in results if not r[1]), sum(r[2] for r in results)
+
+
+def benchmark(mode_args: list, args: argparse.Namespace, origin_port: int) -> None:
+    """Run the proxy in a scratch directory with `mode_args` and report
+    requests/sec and latency percentiles.
+    """
+    proxy_port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        proxy = subprocess.Popen(
+            [sys.executable, PROXY_SCRIPT, '--port', str(proxy_port),
+             '--origin', f'http://127.0.0.1:{origin_port}', *mode_args],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(proxy_port)
+            elapsed, latencies, failed, received = run_load(
+                proxy_port, args.requests, args.concurrency, args.paths,
+                keep_alive=not args.no_keep_alive, gzip=args.gzip
+            )
+        finally:
+            proxy.terminate()
+            proxy.wait()
+
+    label = ' '.join(mode_args) or 'single-threaded'
+    print(f'{label:<45} {args.requests / elapsed:>10.1f} req/s   '
+          f'p50 {percentile(latencies, 50) * 1000:>8.1f} ms   '
+          f'p99 {percentile(latencies, 99) * 1000:>8.1f} ms   '
+          f'{received / args.requests / 1024:>8.1f} KB/req   '
+          f'failed {failed}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='caching-proxy-benchmark',
+        description='Load test caching_proxy.py against a local stub origin'
+    )
+    parser.add_argument('--requests', help='total requests per run', type=int, default=2000)
+    parser.add_argument('--concurrency', help='concurrent clients', type=int, default=32)
+    parser.add_argument('--paths', help='distinct urls requested', type=int, default=50)
+    parser.add_argument('--delay', help='origin delay in seconds', type=float, default=0.05)
+    parser.add_argument('--body-size', help='origin body size in bytes', type=int, default=16 * 1024)
+    parser.add_argument('--workers', help='proxy worker threads', type=int, default=32)
+    parser.add_argument('--no-keep-alive', action='store_true', help='open a new connection per request')
+    parser.add_argument('--text', action='store_true', help='origin serves compressible text/html')
+    parser.add_argument('--gzip', action='store_true', help='clients send Accept-Encoding: gzip')
+    parser.add_argument('--compress-levels', help='comma separated --compress-level values to run, eg. 1,6,9',
+                        default='')
+    args = parser.parse_args()
+
+    origin_port = free_port()
+    origin = stub_origin(origin_port, args.delay, args.body_size, text=args.text)
+
+    print(f'{args.requests} requests, {args.concurrency} clients, {args.paths} urls, '
+          f'origin delay {args.delay * 1000:.0f} ms, body {args.body_size} bytes')
+    benchmark([], args, origin_port)
+    benchmark(['--threaded', '--workers', str(args.workers)], args, origin_port)
+    for level in filter(None, args.compress_levels.split(',')):
+        benchmark(['--threaded', '--workers', str(args.workers), '--compress-level', level], args, origin_port)
+
+    origin.shutdown()
@@ -1,53 +1,378 @@
+import argparse
+import csv
+import heapq
+import io
+import json
+import struct
+import tempfile
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, redirect_stdout
 from vf_db import db
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson import ObjectId
-from time import sleep
+from pymongo.errors import ConnectionFailure, OperationFailure
+from time import perf_counter, sleep
 from vf_lib.connection import loop_all_dbs
 
+try:
+    import numpy as np
+except ImportError:
+    # only needed by the columnar comparison
+    np = None
+
 
 TMP_TABLE_NAME = 'TPM-3194_27Mar'
 
+# (aid, pid, frm) packed into 32 bytes which sort like the server sorts the fields: 12 byte ObjectIds and the
+# frm epoch in milliseconds, biased so that a missing frm (0) sorts first. A run file record adds nsv_norm
+PRICE_KEY = struct.Struct('>12s12sQ')
+PRICE_RECORD = struct.Struct('>12s12sQd')
+EPOCH = datetime(1970, 1, 1)
+EPOCH_BIAS = 2 ** 63
+
 
-def compare_pricing_data(database_list=None, temp_table=TMP_TABLE_NAME, uat_ip='UAT', prod_ip='PROD'):
+def compare_pricing_data(database_list=None, temp_table=TMP_TABLE_NAME, uat_ip='UAT', prod_ip='PROD', mode='dict'):
+    """
+    mode: 'dict' loads both collections into dicts, 'streaming' merge joins them in key order with a constant
+    memory use, 'columnar' compares numpy arrays and reports numeric tolerance stats
+    """
+    compare = PRICING_COMPARISONS[mode]
     if not database_list:
         dbs = sorted(db.security_db.database.distinct('databaseid'))
     else:
         dbs = database_list
     for db_name in dbs:
-        prod = 'promotion_internal_price_{}_{}'.format(temp_table, prod_ip)
-        uat = 'promotion_internal_price_{}_{}'.format(temp_table, uat_ip)
         print('DB: {}'.format(db_name))
         try:
-            db.connect_by_database_id(db_name, '10.0.2.201')
-            a = {(row['aid'], row['pid'], row['frm']): row['prc']['nsv_norm'] for row in
-                 db.user_db[prod].find({}, {"_id": 0, 'pid': 1, 'aid': 1, 'frm': 1, 'prc.nsv_norm': 1}) if row.get('prc', {}).get('nsv_norm')}
-            b = {(row['aid'], row['pid'], row['frm']): row['prc']['nsv_norm'] for row in
-                 db.user_db[uat].find({}, {"_id": 0, 'pid': 1, 'aid': 1, 'frm': 1, 'prc.nsv_norm': 1}) if row.get('prc', {}).get('nsv_norm')}
-
-            mismatch_a = {k: (v, b.get(k)) for k,v in a.items() if v != b.get(k)}
-            if mismatch_a:
-                k = list(mismatch_a.keys())[0]
-                example_a = list(k) + list(mismatch_a[k])
-            else:
-                example_a = ''
-
-            mismatch_b = {k: (v, a.get(k)) for k,v in b.items() if v != a.get(k)}
-            if mismatch_b:
-                k = list(mismatch_b.keys())[0]
-                example_b = list(k) + list(mismatch_b[k])
-            else:
-                example_b = ''
-            print('{}: Prod {} vs Uat {}, mismatches {} (example: {}) vs {} (example: {})'.format(
-                db_name,
-                len(a),
-                len(b),
-                len(mismatch_a),
-                example_a,
-                len(mismatch_b),
-                example_b
-            ))
-        except:
-            print('Error!')
+            retry(compare, db_name, temp_table, uat_ip, prod_ip)
+        except Exception as error:
+            print('{}: Error! {}: {}'.format(db_name, type(error).__name__, error))
+
+
+def retry(func, *args, attempts=4, backoff=1.0, **kwargs):
+    """
+    Call func, retrying with an exponential backoff (backoff, 2 * backoff, ...) when the connection to the
+    server fails. Other errors and the last failure are raised.
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except ConnectionFailure as error:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff * 2 ** attempt
+            print('{}: {}, retrying in {}s'.format(type(error).__name__, error, delay))
+            sleep(delay)
+
+
+def compare_pricing_database(db_name, temp_table=TMP_TABLE_NAME, uat_ip='UAT', prod_ip='PROD', host='10.0.2.201'):
+    """
+    Compare prc.nsv_norm between the prod and uat pricing snapshots of one database
+    Returns:
+        dict with the document counts and the number of mismatches in both directions
+    """
+    prod = 'promotion_internal_price_{}_{}'.format(temp_table, prod_ip)
+    uat = 'promotion_internal_price_{}_{}'.format(temp_table, uat_ip)
+    db.connect_by_database_id(db_name, host)
+    a = {(row['aid'], row['pid'], row['frm']): row['prc']['nsv_norm'] for row in
+         db.user_db[prod].find({}, {"_id": 0, 'pid': 1, 'aid': 1, 'frm': 1, 'prc.nsv_norm': 1}) if row.get('prc', {}).get('nsv_norm')}
+    b = {(row['aid'], row['pid'], row['frm']): row['prc']['nsv_norm'] for row in
+         db.user_db[uat].find({}, {"_id": 0, 'pid': 1, 'aid': 1, 'frm': 1, 'prc.nsv_norm': 1}) if row.get('prc', {}).get('nsv_norm')}
+
+    mismatch_a = {k: (v, b.get(k)) for k,v in a.items() if v != b.get(k)}
+    if mismatch_a:
+        k = list(mismatch_a.keys())[0]
+        example_a = list(k) + list(mismatch_a[k])
+    else:
+        example_a = ''
+
+    mismatch_b = {k: (v, a.get(k)) for k,v in b.items() if v != a.get(k)}
+    if mismatch_b:
+        k = list(mismatch_b.keys())[0]
+        example_b = list(k) + list(mismatch_b[k])
+    else:
+        example_b = ''
+    print('{}: Prod {} vs Uat {}, mismatches {} (example: {}) vs {} (example: {})'.format(
+        db_name,
+        len(a),
+        len(b),
+        len(mismatch_a),
+        example_a,
+        len(mismatch_b),
+        example_b
+    ))
+    return {'prod': len(a), 'uat': len(b), 'mismatches_prod': len(mismatch_a), 'mismatches_uat': len(mismatch_b)}
+
+
+
+def pack_price_key(row):
+    frm = row.get('frm')
+    frm_ms = EPOCH_BIAS + (frm - EPOCH) // timedelta(milliseconds=1) if frm is not None else 0
+    return PRICE_KEY.pack(row['aid'].binary, row['pid'].binary, frm_ms)
+
+
+def unpack_price_key(key):
+    aid, pid, frm_ms = PRICE_KEY.unpack(key)
+    frm = EPOCH + timedelta(milliseconds=frm_ms - EPOCH_BIAS) if frm_ms else None
+    return [ObjectId(aid), ObjectId(pid), frm]
+
+
+def last_per_key(rows):
+    """
+    Collapse consecutive (key, value) pairs with the same key, the last value wins like it does when the rows
+    are loaded into a dict
+    """
+    previous_key = previous_value = None
+    for key, value in rows:
+        if previous_key is not None and key != previous_key:
+            yield previous_key, previous_value
+        previous_key, previous_value = key, value
+    if previous_key is not None:
+        yield previous_key, previous_value
+
+
+def nsv_norm_rows(collection, sort=True):
+    """
+    Stream (packed key, prc.nsv_norm) of the documents with a nsv_norm, in key order when sort is set
+    """
+    cursor = collection.find(
+        {}, {"_id": 0, 'pid': 1, 'aid': 1, 'frm': 1, 'prc.nsv_norm': 1},
+        sort=[('aid', 1), ('pid', 1), ('frm', 1)] if sort else None,
+        batch_size=10000
+    )
+    for row in cursor:
+        nsv_norm = row.get('prc', {}).get('nsv_norm')
+        if nsv_norm:
+            yield pack_price_key(row), nsv_norm
+
+
+def external_sort(rows, stack, run_size=200000):
+    """
+    Sort (packed key, nsv_norm) pairs which don't fit in memory: sorted runs of run_size records are written
+    to temporary files (closed by stack) and merged back, memory use is bounded by run_size
+    """
+    runs = []
+
+    def write_run(records):
+        records.sort(key=lambda record: record[:PRICE_KEY.size])
+        run = stack.enter_context(tempfile.TemporaryFile())
+        run.write(b''.join(records))
+        run.seek(0)
+        runs.append(run)
+
+    records = []
+    for key, nsv_norm in rows:
+        records.append(key + struct.pack('>d', nsv_norm))
+        if len(records) >= run_size:
+            write_run(records)
+            records = []
+    if records:
+        write_run(records)
+
+    def read_run(run):
+        while True:
+            record = run.read(PRICE_RECORD.size)
+            if not record:
+                return
+            yield record
+
+    # heapq.merge keeps the runs in cursor order for equal keys, so the last value still wins
+    for record in heapq.merge(*(read_run(run) for run in runs), key=lambda record: record[:PRICE_KEY.size]):
+        yield record[:PRICE_KEY.size], PRICE_RECORD.unpack(record)[3]
+
+
+def compare_pricing_database_streaming(db_name, temp_table=TMP_TABLE_NAME, uat_ip='UAT', prod_ip='PROD',
+                                       host='10.0.2.201', server_sort=True, run_size=200000):
+    """
+    Same comparison and output as compare_pricing_database with a memory use which does not grow with the
+    collection size: both collections are read in (aid, pid, frm) order and merge joined instead of loaded
+    into dicts. When the server can't sort (eg. the sort exceeds its memory limit) or server_sort is False
+    the rows are sorted locally through run files of run_size records.
+    Returns:
+        dict with the document counts and the number of mismatches in both directions
+    """
+    prod = 'promotion_internal_price_{}_{}'.format(temp_table, prod_ip)
+    uat = 'promotion_internal_price_{}_{}'.format(temp_table, uat_ip)
+    db.connect_by_database_id(db_name, host)
+
+    def compare(rows_prod, rows_uat):
+        summary = {'prod': 0, 'uat': 0, 'mismatches_prod': 0, 'mismatches_uat': 0}
+        example_a = example_b = ''
+        for key, nsv_prod, nsv_uat in merge_join(last_per_key(rows_prod), last_per_key(rows_uat)):
+            if nsv_prod is not None:
+                summary['prod'] += 1
+                if nsv_prod != nsv_uat:
+                    summary['mismatches_prod'] += 1
+                    example_a = example_a or unpack_price_key(key) + [nsv_prod, nsv_uat]
+            if nsv_uat is not None:
+                summary['uat'] += 1
+                if nsv_uat != nsv_prod:
+                    summary['mismatches_uat'] += 1
+                    example_b = example_b or unpack_price_key(key) + [nsv_uat, nsv_prod]
+        return summary, example_a, example_b
+
+    summary = None
+    if server_sort:
+        try:
+            summary, example_a, example_b = compare(nsv_norm_rows(db.user_db[prod]), nsv_norm_rows(db.user_db[uat]))
+        except OperationFailure as error:
+            print(db_name, 'server side sort failed, sorting locally: {}'.format(error))
+    if summary is None:
+        with ExitStack() as stack:
+            summary, example_a, example_b = compare(
+                external_sort(nsv_norm_rows(db.user_db[prod], sort=False), stack, run_size),
+                external_sort(nsv_norm_rows(db.user_db[uat], sort=False), stack, run_size)
+            )
+
+    print('{}: Prod {} vs Uat {}, mismatches {} (example: {}) vs {} (example: {})'.format(
+        db_name,
+        summary['prod'],
+        summary['uat'],
+        summary['mismatches_prod'],
+        example_a,
+        summary['mismatches_uat'],
+        example_b
+    ))
+    return summary
+
+
+
+def nsv_norm_columns(collection):
+    """
+    Load (packed key, prc.nsv_norm) of the documents with a nsv_norm into numpy arrays sorted by key, a key
+    repeated in the collection keeps its last value like a dict would
+    """
+    keys = bytearray()
+    values = array('d')
+    for key, nsv_norm in nsv_norm_rows(collection, sort=False):
+        keys += key
+        values.append(float(nsv_norm))
+    keys = np.frombuffer(bytes(keys), dtype='S{}'.format(PRICE_KEY.size))
+    values = np.frombuffer(values, dtype=np.float64) if values else np.empty(0)
+
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    last = np.ones(len(keys), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    return keys[last], values[last]
+
+
+def compare_pricing_database_columnar(db_name, temp_table=TMP_TABLE_NAME, uat_ip='UAT', prod_ip='PROD',
+                                      host='10.0.2.201', rtol=0.0, atol=0.0):
+    """
+    Same comparison as compare_pricing_database done on numpy arrays: keys and nsv_norm values are loaded as
+    columns, aligned on the sorted keys and compared in one vectorized step. Values count as equal when
+    within the tolerance of numpy.isclose, the differences hidden by the tolerance are reported separately.
+    Args:
+        rtol: relative tolerance
+        atol: absolute tolerance
+    Returns:
+        dict with the document counts, the number of mismatches in both directions and the difference stats
+    """
+    if np is None:
+        raise ImportError('the columnar comparison needs numpy')
+    prod = 'promotion_internal_price_{}_{}'.format(temp_table, prod_ip)
+    uat = 'promotion_internal_price_{}_{}'.format(temp_table, uat_ip)
+    db.connect_by_database_id(db_name, host)
+
+    keys_prod, values_prod = nsv_norm_columns(db.user_db[prod])
+    keys_uat, values_uat = nsv_norm_columns(db.user_db[uat])
+    common, index_prod, index_uat = np.intersect1d(keys_prod, keys_uat, assume_unique=True, return_indices=True)
+    aligned_prod = values_prod[index_prod]
+    aligned_uat = values_uat[index_uat]
+    different = ~np.isclose(aligned_prod, aligned_uat, rtol=rtol, atol=atol, equal_nan=True)
+    not_exact = aligned_prod != aligned_uat
+    differences = np.abs(aligned_prod - aligned_uat)[different]
+
+    only_prod = len(keys_prod) - len(common)
+    only_uat = len(keys_uat) - len(common)
+    summary = {
+        'prod': len(keys_prod),
+        'uat': len(keys_uat),
+        'mismatches_prod': only_prod + int(different.sum()),
+        'mismatches_uat': only_uat + int(different.sum()),
+        'only_prod': only_prod,
+        'only_uat': only_uat,
+        'within_tolerance': int((not_exact & ~different).sum()),
+        'max_abs_diff': float(differences.max()) if len(differences) else 0.0,
+        'mean_abs_diff': float(differences.mean()) if len(differences) else 0.0,
+    }
+
+    def example(keys, values, other_keys, aligned, aligned_other):
+        # first differing common key, else the first key missing on the other side, the own value comes
+        # first like in compare_pricing_database
+        if different.any():
+            position = np.flatnonzero(different)[0]
+            return unpack_price_key(common[position:position + 1].tobytes()) + [
+                float(aligned[position]), float(aligned_other[position])]
+        missing = np.setdiff1d(keys, other_keys, assume_unique=True)
+        if len(missing):
+            position = np.searchsorted(keys, missing[0])
+            return unpack_price_key(missing[:1].tobytes()) + [float(values[position])]
+        return ''
+
+    example_a = example(keys_prod, values_prod, keys_uat, aligned_prod, aligned_uat)
+    example_b = example(keys_uat, values_uat, keys_prod, aligned_uat, aligned_prod)
+    print('{}: Prod {} vs Uat {}, mismatches {} (example: {}) vs {} (example: {})'.format(
+        db_name,
+        summary['prod'],
+        summary['uat'],
+        summary['mismatches_prod'],
+        example_a,
+        summary['mismatches_uat'],
+        example_b
+    ))
+    print('{}: rtol {} atol {}, only prod {}, only uat {}, within tolerance {}, max abs diff {}, '
+          'mean abs diff {}'.format(
+        db_name, rtol, atol, only_prod, only_uat, summary['within_tolerance'], summary['max_abs_diff'],
+        summary['mean_abs_diff']
+    ))
+    return summary
+
+
+PRICING_COMPARISONS = {
+    'dict': compare_pricing_database,
+    'streaming': compare_pricing_database_streaming,
+    'columnar': compare_pricing_database_columnar,
+}
+
+
+def freeze(value):
+    """
+    Hashable form of a prc.disc entry, dicts and lists become (sorted) tuples
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def diff_discounts(disc_uat, disc_prod):
+    """
+    Multiset difference of two prc.disc lists in linear time, a value present twice in uat and once in prod
+    is reported once as extra uat value
+    Returns:
+        (extra_values_uat, extra_values_prod)
+    """
+    frozen_uat = [freeze(x) for x in disc_uat or []]
+    frozen_prod = [freeze(x) for x in disc_prod or []]
+    counts_uat = Counter(frozen_uat)
+    counts_prod = Counter(frozen_prod)
+
+    def extra(values, frozen, counts):
+        remaining = counts.copy()
+        extra_values = []
+        for value, key in zip(values, frozen):
+            if remaining[key] > 0:
+                remaining[key] -= 1
+                extra_values.append(value)
+        return extra_values
+
+    return (extra(disc_uat or [], frozen_uat, counts_uat - counts_prod),
+            extra(disc_prod or [], frozen_prod, counts_prod - counts_uat))
 
 
 
@@ -67,8 +392,124 @@ def compare_pricing_data(database_list=None, temp_table=TMP_TABLE_NAME, uat_ip='
 #aid = ObjectId('6152cd29de8e30a2f76c545d')
 
 
+def aid_summaries(collection, query=None, content_hash=False):
+    """
+    Document count per account in a single aggregation pass, instead of a count_documents per aid. With
+    content_hash an order independent fingerprint of (pid, frm, to, prc.disc) is added: the sum of the hashed
+    documents modulo 2**31, so it stays an exact integer. Two accounts with the same count and fingerprint hold
+    the same prices. The fingerprint needs a server with $toHashedIndexKey, leave it off for older servers or a
+    mongomock style stand-in.
+    Args:
+        collection: pymongo (or compatible) collection
+        query: optional filter applied before grouping
+        content_hash: add the fingerprint of the documents
+
+    Returns:
+        dict of aid: {'count': int} with a 'hash' int when content_hash is set
+    """
+    group = {'_id': '$aid', 'count': {'$sum': 1}}
+    if content_hash:
+        hashed = {'$toHashedIndexKey': {'pid': '$pid', 'frm': '$frm', 'to': '$to', 'disc': '$prc.disc'}}
+        group['hash'] = {'$sum': {'$abs': {'$mod': [hashed, 2 ** 31]}}}
+    pipeline = [{'$match': query}] if query else []
+    pipeline.append({'$group': group})
+    return {row.pop('_id'): row for row in collection.aggregate(pipeline, allowDiskUse=True)}
+
+
+def differing_aids(summaries_uat, summaries_prod):
+    """
+    Accounts of two aid_summaries results whose count or fingerprint differ, or which are only on one side,
+    documents without an aid are grouped under None which doesn't compare with ObjectId, hence the str key
+    """
+    return sorted((aid for aid in set(summaries_uat) | set(summaries_prod)
+                   if summaries_uat.get(aid) != summaries_prod.get(aid)), key=str)
+
+
+# the find_one lookups of check_promotion_internal_price match all four fields
+LOOKUP_INDEX = [('aid', 1), ('pid', 1), ('frm', 1), ('to', 1)]
+
+
+def lookup_index(collection):
+    """
+    Name of an index of the collection which serves the (aid, pid, frm, to) lookup: its first four keys are
+    those fields, in any order since the lookup matches all of them. None when there is no such index.
+    """
+    fields = {field for field, _ in LOOKUP_INDEX}
+    for name, info in collection.index_information().items():
+        if {field for field, _ in info['key'][:len(fields)]} == fields:
+            return name
+    return None
+
+
+def explain_lookup(collection, query):
+    """
+    Explain the lookup of check_promotion_internal_price on the collection. The query runs without a limit
+    so a collection scan examines (and times) every document, the time of a find_one is then estimated from
+    the documents it examines: half of the collection on average for a scan, since it stops at the match.
+    Returns:
+        dict with the winning plan stages (eg. 'COLLSCAN' or 'IXSCAN'), documents examined, collection size
+        and the estimated server time per lookup
+    """
+    plan = collection.find(query, {'_id': 0, 'prc.disc': 1}).explain()
+    stages = []
+    stage = plan['queryPlanner']['winningPlan']
+    while stage:
+        stages.append(stage['stage'])
+        stage = stage.get('inputStage')
+    stats = plan.get('executionStats', {})
+    examined = stats.get('totalDocsExamined') or 0
+    size = collection.estimated_document_count()
+    per_lookup = size / 2 if 'COLLSCAN' in stages else examined
+    ms = stats.get('executionTimeMillis', 0)
+    return {
+        'stages': stages,
+        'docs_examined': examined,
+        'collection_size': size,
+        'ms': ms * per_lookup / examined if examined else ms,
+    }
+
+
+def index_preflight(collections, sample_query, lookups, build_index=False):
+    """
+    Check that the lookup of check_promotion_internal_price is served by an index on every collection and
+    optionally build the missing compound index. The build blocks until the index is ready, the server
+    ignores the background option since 4.2.
+    Args:
+        collections: the uat and prod collections
+        sample_query: an (aid, pid, frm, to) query the lookup will run, a random one so the estimate does
+            not depend on where the key is stored
+        lookups: number of lookups expected per collection, used to estimate the time the index saves
+        build_index: build LOOKUP_INDEX where no index serves the lookup
+
+    Returns:
+        dict with the estimated seconds of the lookups with the plan before and after the pre-flight (the same
+        when no index is built), the seconds spent building and the number of indexes built
+    """
+    estimate = {'before': 0.0, 'after': 0.0, 'build': 0.0, 'built': 0}
+    for collection in collections:
+        index = lookup_index(collection)
+        before = explain_lookup(collection, sample_query)
+        print(collection.name, 'index: {}, plan: {}, documents examined: {} of {}, {:.1f} ms per lookup'.format(
+            index, ' <- '.join(before['stages']), before['docs_examined'], before['collection_size'], before['ms']))
+        after = before
+        if index is None and build_index:
+            start = perf_counter()
+            index = collection.create_index(LOOKUP_INDEX)
+            estimate['build'] += perf_counter() - start
+            estimate['built'] += 1
+            after = explain_lookup(collection, sample_query)
+            print(collection.name, 'built index {} in {:.1f}s, plan: {}, {:.1f} ms per lookup'.format(
+                index, perf_counter() - start, ' <- '.join(after['stages']), after['ms']))
+        elif index is None:
+            print(collection.name, 'no index serves the lookup, every find_one scans the collection')
+        estimate['before'] += lookups * before['ms'] / 1000
+        estimate['after'] += lookups * after['ms'] / 1000
+    return estimate
+
+
 def check_promotion_internal_price(aid_filter=None, pid_filter=None, uat_collection='promotion_internal_price_simulation',
-                                   prod_collection='promotion_internal_price', slow_output=0.0, verbose_level=0):
+                                   prod_collection='promotion_internal_price', slow_output=0.0, verbose_level=0,
+                                   skip_matching=False, database=None, check_indexes=False, build_index=False):
     """
     The combination of account, product, to, frm is used to check if prc.disc value is the same between the collections
     generated from sap_pricing_test.py
@@ -82,6 +523,13 @@ def check_promotion_internal_price(aid_filter=None, pid_filter=None, uat_collect
         prod_collection: collection where pricing was generated using production code
         slow_output: float, seconds to delay product output information, useful if no aid or pid is set
         verbose_level: 0 for standard output, 1 for product details, 2 for product discount details
+        skip_matching: fingerprint the accounts first (see aid_summaries) and only compare the products of
+            accounts where the counts or fingerprints differ
+        database: database holding the collections, defaults to db.user_db, any object returning pymongo
+            compatible collections by name can be used
+        check_indexes: explain the product lookup first and report whether an index serves it, see
+            index_preflight, the estimated and actual time saved are reported at the end
+        build_index: with check_indexes, build the compound lookup index where it is missing
 
     Returns:
         terminal output information for different verbose levels
@@ -92,24 +540,26 @@ def check_promotion_internal_price(aid_filter=None, pid_filter=None, uat_collect
         verbose_level == 2:
             (db_name, aid, pid, frm, to) where there is a difference in the prc.disc value and
             (db_name, 'uat: ', extra_values_uat, 'prod: ', extra_values_prod) where extra_values_uat is a value in the
-            prc.disc list which is not in extra_value_prod and vice versa
+            prc.disc list which is not in extra_value_prod and vice versa (as multisets, so a value repeated more
+            often on one side is reported too)
     """
-    db_name = db.user_db.name
-    collection_uat = db.user_db[uat_collection]
-    collection_prod = db.user_db[prod_collection]
-    aid_filter = aid_filter or collection_uat.distinct('aid')
+    database = database or db.user_db
+    db_name = database.name
+    collection_uat = database[uat_collection]
+    collection_prod = database[prod_collection]
+
+    # one aggregation per collection instead of two count_documents per account
+    query = {'aid': {'$in': list(aid_filter)}} if aid_filter else None
+    summaries_uat = aid_summaries(collection_uat, query, content_hash=skip_matching)
+    summaries_prod = aid_summaries(collection_prod, query, content_hash=skip_matching)
+    aid_filter = aid_filter or sorted(aid for aid in summaries_uat if aid is not None)
 
-    count_prod = 0
-    count_uat = 0
     if aid_filter:
-        for aid in aid_filter:
-            count_prod_per_aid = collection_prod.count_documents({'aid': aid})
-            count_prod += count_prod_per_aid
-            count_uat_per_aid = collection_uat.count_documents({'aid': aid})
-            count_uat += count_uat_per_aid
+        count_prod = sum(summaries_prod[aid]['count'] for aid in aid_filter if aid in summaries_prod)
+        count_uat = sum(summaries_uat[aid]['count'] for aid in aid_filter if aid in summaries_uat)
     else:
-        count_prod = collection_prod.count_documents({})
-        count_uat = collection_uat.count_documents({})
+        count_prod = sum(summary['count'] for summary in summaries_prod.values())
+        count_uat = sum(summary['count'] for summary in summaries_uat.values())
 
     # check the overall collection size
     if count_uat == 0 and count_prod == 0:
@@ -122,6 +572,24 @@ def check_promotion_internal_price(aid_filter=None, pid_filter=None, uat_collect
     elif count_uat != count_prod:
         print(db_name, 'collections are not the same, uat: {} != prod: {}'.format(count_uat, count_prod))
 
+    if skip_matching:
+        different = set(differing_aids(summaries_uat, summaries_prod))
+        skipped = [aid for aid in aid_filter if aid not in different]
+        aid_filter = [aid for aid in aid_filter if aid in different]
+        print(db_name, 'skipping {} matching accounts, comparing {}'.format(len(skipped), len(aid_filter)))
+
+    estimate = None
+    if check_indexes or build_index:
+        # a random key, the first one in natural order is found by a scan straight away
+        sample_query = next(collection_uat.aggregate([
+            {'$match': {'aid': {'$in': aid_filter}} if aid_filter else {}},
+            {'$sample': {'size': 1}},
+            {'$project': {'_id': 0, 'aid': 1, 'pid': 1, 'frm': 1, 'to': 1}},
+        ]), None)
+        if sample_query:
+            estimate = index_preflight([collection_uat, collection_prod], sample_query, count_uat, build_index)
+    start = perf_counter()
+
     qp = {'_id': 0, 'prc.disc': 1}
 
     # loop through the accounts
@@ -157,48 +625,442 @@ def check_promotion_internal_price(aid_filter=None, pid_filter=None, uat_collect
                         sleep(slow_output)
 
                         if verbose_level == 2:
-                            extra_values_uat = [x for x in disc_uat if x not in disc_prod]
-                            extra_values_prod = [x for x in disc_prod if x not in disc_uat]
+                            extra_values_uat, extra_values_prod = diff_discounts(disc_uat, disc_prod)
                             print(db_name, 'uat: ', extra_values_uat, 'prod: ', extra_values_prod)
 
         if product_issue_found and verbose_level < 1:
             print(db_name, 'product issue found, set verbose_level=1 for details and 2 for details & values')
 
+    if estimate:
+        elapsed = perf_counter() - start
+        print(db_name, 'lookups took {:.1f}s, estimated {:.1f}s before and {:.1f}s after the index pre-flight'.format(
+            elapsed, estimate['before'], estimate['after']))
+        if estimate['built']:
+            print(db_name, 'time saved estimated {:.1f}s, actual {:.1f}s (including {:.1f}s building the index)'.format(
+                estimate['before'] - estimate['after'] - estimate['build'],
+                estimate['before'] - elapsed - estimate['build'], estimate['build']))
 
 
-db.security_connect()
-db_list = sorted(
-    x for x in db.security_db.database.distinct('databaseid') if
-    'demo' not in x and
-    'zendesk' not in x and
-    'qa' not in x and
-    'bootcamp' not in x and
-    'test' not in x and
-    'system_reporting' not in x and
-    'deloitte' not in x and
-    'bpx' not in x
-)
 
-# loop through the databases
-for database_name in db_list:
+def promotion_price_key(row):
+    """
+    Merge key of a promotion_internal_price document, ordered the same way as the server sorts
+    {aid: 1, pid: 1, frm: 1, to: 1}: missing/null values sort first
+    """
+    return tuple((row.get(field) is not None, row.get(field)) for field in ('aid', 'pid', 'frm', 'to'))
+
+
+def sorted_promotion_prices(collection, query, batch_size=10000):
+    """
+    Stream the documents of a promotion_internal_price collection in merge key order, only the fields
+    needed for the comparison are fetched. Documents repeating a key are skipped, the first one wins like
+    find_one would.
+    """
+    cursor = collection.find(
+        query,
+        {'_id': 0, 'aid': 1, 'pid': 1, 'frm': 1, 'to': 1, 'prc.disc': 1},
+        sort=[('aid', 1), ('pid', 1), ('frm', 1), ('to', 1)],
+        batch_size=batch_size,
+        allow_disk_use=True
+    )
+    previous_key = None
+    for row in cursor:
+        key = promotion_price_key(row)
+        if key != previous_key:
+            previous_key = key
+            yield key, row
+
+
+def merge_join(rows_left, rows_right):
+    """
+    Walk two key ordered streams of (key, row) side by side
+
+    Returns:
+        generator of (key, row_left, row_right), row_left or row_right is None when the key is only on one side
+    """
+    sentinel = (None, None)
+    key_left, row_left = next(rows_left, sentinel)
+    key_right, row_right = next(rows_right, sentinel)
+    while row_left is not None or row_right is not None:
+        if row_right is None or (row_left is not None and key_left < key_right):
+            yield key_left, row_left, None
+            key_left, row_left = next(rows_left, sentinel)
+        elif row_left is None or key_right < key_left:
+            yield key_right, None, row_right
+            key_right, row_right = next(rows_right, sentinel)
+        else:
+            yield key_left, row_left, row_right
+            key_left, row_left = next(rows_left, sentinel)
+            key_right, row_right = next(rows_right, sentinel)
+
+
+def check_promotion_internal_price_bulk(aid_filter=None, pid_filter=None,
+                                        uat_collection='promotion_internal_price_simulation',
+                                        prod_collection='promotion_internal_price', slow_output=0.0, verbose_level=0,
+                                        skip_matching=False, database=None, exclude_aids=None, on_account_done=None):
+    """
+    Bulk version of check_promotion_internal_price: instead of distinct + find_one per (aid, pid, frm, to)
+    both collections are read once, sorted on the composite key, and merge joined in a single pass. Memory
+    use is bounded by the cursor batch size, independent of the collection size.
+    Unlike check_promotion_internal_price it also reports keys which only exist in prod.
+    Example usage:
+        check_promotion_internal_price_bulk([aid], [pid])
+    Args:
+        aid_filter: list of ObjectId values
+        pid_filter: list of ObjectId values
+        uat_collection: collection where pricing was generated using uat code
+        prod_collection: collection where pricing was generated using production code
+        slow_output: float, seconds to delay product output information, useful if no aid or pid is set
+        verbose_level: 0 for standard output, 1 for product details, 2 for product discount details
+        skip_matching: only merge join the accounts where the counts or fingerprints differ
+        database: database holding the collections, defaults to db.user_db
+        exclude_aids: accounts which are already checked, eg. by an interrupted run, the counts only cover
+            the other accounts
+        on_account_done: called with the aid and the number of missing and mismatching products of every
+            account once all its products are compared
+
+    Returns:
+        terminal output information for different verbose levels, same as check_promotion_internal_price
+        and a dict with the document counts and the number of missing and mismatching products, 'empty' names
+        the collection without data when only one of them is empty
+    """
+    database = database or db.user_db
+    db_name = database.name
+    collection_uat = database[uat_collection]
+    collection_prod = database[prod_collection]
+
+    query = {}
+    if aid_filter:
+        query['aid'] = {'$in': list(aid_filter)}
+    if pid_filter:
+        query['pid'] = {'$in': list(pid_filter)}
+    if exclude_aids:
+        query.setdefault('aid', {})['$nin'] = list(exclude_aids)
+
+    summaries_uat = aid_summaries(collection_uat, query, content_hash=skip_matching)
+    summaries_prod = aid_summaries(collection_prod, query, content_hash=skip_matching)
+    count_prod = sum(summary['count'] for summary in summaries_prod.values())
+    count_uat = sum(summary['count'] for summary in summaries_uat.values())
+
+    # check the overall collection size
+    summary = {'uat': count_uat, 'prod': count_prod, 'missing': 0, 'mismatches': 0}
+    if count_uat == 0 and count_prod == 0:
+        print(db_name, 'no data in uat or prod')
+        return summary
+    elif count_uat == 0 or count_prod == 0:
+        # pricing test did not yield any data, skip the database but report it as an issue
+        print(db_name, 'a collection is empty, uat: {} vs prod: {}'.format(count_uat, count_prod))
+        summary['empty'] = 'uat' if count_uat == 0 else 'prod'
+        return summary
+    elif count_uat != count_prod:
+        print(db_name, 'collections are not the same, uat: {} != prod: {}'.format(count_uat, count_prod))
+
+    if skip_matching:
+        different = differing_aids(summaries_uat, summaries_prod)
+        summary['skipped_accounts'] = len(set(summaries_uat) | set(summaries_prod)) - len(different)
+        print(db_name, 'skipping {} matching accounts, comparing {}'.format(
+            summary['skipped_accounts'], len(different)))
+        if not different:
+            return summary
+        query.setdefault('aid', {})['$in'] = different
+
+    current_aid = None
+    product_issue_found = False
+    account_start = (0, 0)
+
+    def account_done():
+        if on_account_done and current_aid is not None:
+            on_account_done(current_aid, summary['missing'] - account_start[0],
+                            summary['mismatches'] - account_start[1])
+
+    for key, product_uat, product_prod in merge_join(sorted_promotion_prices(collection_uat, query),
+                                                     sorted_promotion_prices(collection_prod, query)):
+        aid, pid, frm, to = (value for _, value in key)
+        if aid != current_aid:
+            if product_issue_found and verbose_level < 1:
+                print(db_name, 'product issue found, set verbose_level=1 for details and 2 for details & values')
+            account_done()
+            current_aid = aid
+            account_start = (summary['missing'], summary['mismatches'])
+            product_issue_found = False
+
+        if not product_uat or not product_prod:
+            summary['missing'] += 1
+            print(db_name, aid, pid, frm, to, 'missing product data, uat: {} vs prod: {}'.format(
+                bool(product_uat), bool(product_prod)))
+            continue
+        disc_uat = product_uat.get('prc', {}).get('disc')
+        disc_prod = product_prod.get('prc', {}).get('disc')
+        if disc_prod != disc_uat:
+            summary['mismatches'] += 1
+            product_issue_found = True
+            if verbose_level >= 1:
+                print(db_name, aid, pid, frm, to)
+                sleep(slow_output)
+
+                if verbose_level == 2:
+                    extra_values_uat, extra_values_prod = diff_discounts(disc_uat, disc_prod)
+                    print(db_name, 'uat: ', extra_values_uat, 'prod: ', extra_values_prod)
+
+    if product_issue_found and verbose_level < 1:
+        print(db_name, 'product issue found, set verbose_level=1 for details and 2 for details & values')
+    account_done()
+    return summary
+
+
+def check_promotion_internal_price_database(database_name, **kwargs):
     db.connect_by_database_id(database_name)
-    check_promotion_internal_price(TMP_TABLE_NAME)
+    return check_promotion_internal_price_bulk(**kwargs)
 
 
-@loop_all_dbs()
-def purge_test_collections(clean=False):
-    tmp_table_name = 'TPM-3194_27Mar'
-    production_collections = ['sap_condition', 'promotion_internal_price']
+# checks which run_validation can run on every database, by name so they can be sent to worker processes
+VALIDATION_CHECKS = {
+    'promotion_internal_price': check_promotion_internal_price_database,
+    'pricing_data': compare_pricing_database,
+    'pricing_data_streaming': compare_pricing_database_streaming,
+    'pricing_data_columnar': compare_pricing_database_columnar,
+}
+# checks which can skip the accounts finished by an interrupted run
+ACCOUNT_CHECKS = {'promotion_internal_price'}
+
+
+class Checkpoint:
+    """
+    Append only state file of the finished units of run_validation, one json line per database or account.
+    Worker processes append their finished accounts to the same file, the lines are short enough to be
+    written atomically.
+    """
+
+    def __init__(self, path, check):
+        self.path = path
+        self.check = check
+
+    def load(self):
+        """
+        Returns:
+            (set of finished databases, dict of database: {aid: record} of the finished accounts)
+        """
+        databases = set()
+        accounts = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # line cut short by a crash
+                        continue
+                    if record.get('check') != self.check:
+                        continue
+                    if 'aid' in record:
+                        accounts.setdefault(record['database'], {})[ObjectId(record['aid'])] = record
+                    else:
+                        databases.add(record['database'])
+        except FileNotFoundError:
+            pass
+        return databases, accounts
+
+    def mark(self, database, aid=None, **fields):
+        record = {'check': self.check, 'database': database}
+        if aid is not None:
+            record['aid'] = str(aid)
+        record.update(fields)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
 
+class ResultWriter:
+    """
+    Write the per database results of run_validation as they finish, so partial results of a long run are
+    usable. Paths ending in .csv get one row per database with the main summary fields, anything else gets
+    the full result as json lines. The file is appended to, so resumed runs add to it.
+    """
+    CSV_FIELDS = ['database', 'check', 'status', 'seconds', 'uat', 'prod', 'empty', 'missing', 'mismatches',
+                  'mismatches_prod', 'mismatches_uat', 'error']
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', newline='')
+        self.csv = None
+        if path.endswith('.csv'):
+            self.csv = csv.DictWriter(self.file, self.CSV_FIELDS, extrasaction='ignore')
+            if self.file.tell() == 0:
+                self.csv.writeheader()
+
+    def write(self, result):
+        if self.csv:
+            self.csv.writerow(dict(result.get('summary') or {}, **result))
+        else:
+            self.file.write(json.dumps(result, default=str) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def validate_database(database_name, check, check_kwargs, state_path=None, retries=3, resume=False):
+    """
+    Worker of run_validation: connect to one database and run a check on it, the output of the check is
+    captured instead of printed so the workers don't interleave. Connection failures are retried, with
+    state_path the finished accounts are recorded and a retry skips the ones of the failed attempt, with
+    resume as well those of an earlier run. The issues of the skipped accounts are added to the summary.
+    Returns:
+        dict with the database name, status ('ok', 'issues' or 'error'), the check summary, output lines and
+        duration
+    """
+    start = perf_counter()
+    output = io.StringIO()
+    result = {'database': database_name, 'check': check}
+    checkpoint = Checkpoint(state_path, check) if state_path and check in ACCOUNT_CHECKS else None
+
+    def mark_account(aid, missing, mismatches):
+        checkpoint.mark(database_name, aid, missing=missing, mismatches=mismatches)
+
+    retrying = False
+
+    def run_check():
+        nonlocal retrying
+        kwargs = dict(check_kwargs)
+        finished = {}
+        if checkpoint:
+            if resume or retrying:
+                finished = checkpoint.load()[1].get(database_name, {})
+                kwargs['exclude_aids'] = list(finished)
+            kwargs['on_account_done'] = mark_account
+        retrying = True
+        summary = VALIDATION_CHECKS[check](database_name, **kwargs)
+        if finished:
+            summary['resumed_accounts'] = len(finished)
+            for field in ('missing', 'mismatches'):
+                summary[field] += sum(record.get(field, 0) for record in finished.values())
+        return summary
+
+    try:
+        with redirect_stdout(output):
+            summary = retry(run_check, attempts=retries + 1)
+        result['summary'] = summary
+        issues = any(value for name, value in summary.items() if name.startswith(('missing', 'mismatches', 'empty')))
+        result['status'] = 'issues' if issues else 'ok'
+    except Exception as error:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['output'] = output.getvalue().splitlines()
+    result['seconds'] = round(perf_counter() - start, 2)
+    return result
+
+
+def connect_worker():
+    db.security_connect()
+
+
+def run_validation(database_list, check='promotion_internal_price', workers=4, report_path=None, output_path=None,
+                   state_path=None, resume=False, retries=3, **check_kwargs):
+    """
+    Run a check on many databases in parallel. Every worker is a separate process with its own vf_db
+    connection, since db holds a single user database at a time threads can't share it.
+    Example usage:
+        run_validation(production_databases(), workers=8, report_path='report.json', verbose_level=1)
+    Args:
+        database_list: list of database ids
+        check: name of the check in VALIDATION_CHECKS
+        workers: number of worker processes
+        report_path: optional path the json report is written to
+        output_path: optional .jsonl or .csv file every result is appended to as soon as it is done
+        state_path: optional checkpoint file, finished databases (and accounts) are recorded in it, it is
+            started afresh unless resuming
+        resume: skip the databases (and accounts) the checkpoint file lists as finished
+        retries: number of retries of a database after a connection failure
+        check_kwargs: passed on to the check
+
+    Returns:
+        the report, a dict with a summary and the per database results sorted by database
+    """
+    start = perf_counter()
+    checkpoint = Checkpoint(state_path, check) if state_path else None
+    if resume and checkpoint:
+        finished = checkpoint.load()[0]
+        database_list = [name for name in database_list if name not in finished]
+        print('resuming, {} databases already done'.format(len(finished)))
+    elif checkpoint:
+        # the records of an earlier run would otherwise be picked up by the next --resume
+        open(state_path, 'w').close()
+    total = len(database_list)
+    results = []
+    writer = ResultWriter(output_path) if output_path else None
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=connect_worker) as pool:
+            futures = [pool.submit(validate_database, name, check, check_kwargs, state_path, retries, resume)
+                       for name in database_list]
+            for done, future in enumerate(as_completed(futures), start=1):
+                result = future.result()
+                results.append(result)
+                if writer:
+                    writer.write(result)
+                if checkpoint and result['status'] != 'error':
+                    checkpoint.mark(result['database'], status=result['status'])
+                elapsed = perf_counter() - start
+                eta = elapsed / done * (total - done)
+                print('[{}/{}] {} {} in {}s, elapsed {:.0f}s, eta {:.0f}s'.format(
+                    done, total, result['database'], result['status'], result['seconds'], elapsed, eta))
+    finally:
+        if writer:
+            writer.close()
+
+    results.sort(key=lambda r: r['database'])
+    report = {
+        'check': check,
+        'databases': total,
+        'seconds': round(perf_counter() - start, 2),
+        'ok': [r['database'] for r in results if r['status'] == 'ok'],
+        'issues': [r['database'] for r in results if r['status'] == 'issues'],
+        'errors': [r['database'] for r in results if r['status'] == 'error'],
+        'results': results,
+    }
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    print('{} databases in {}s: {} ok, {} with issues, {} errors'.format(
+        total, report['seconds'], len(report['ok']), len(report['issues']), len(report['errors'])))
+    return report
+
+
+def production_databases():
+    return sorted(
+        x for x in db.security_db.database.distinct('databaseid') if
+        'demo' not in x and
+        'zendesk' not in x and
+        'qa' not in x and
+        'bootcamp' not in x and
+        'test' not in x and
+        'system_reporting' not in x and
+        'deloitte' not in x and
+        'bpx' not in x
+    )
+
+
+PRODUCTION_COLLECTIONS = ['sap_condition', 'promotion_internal_price']
+
+
+def test_collections(collection_names, tmp_table_name=TMP_TABLE_NAME, production_collections=PRODUCTION_COLLECTIONS):
+    """
+    Test copies of the production collections in one listing of a database: all prefixes are matched against
+    the same list, the current test run (tmp_table_name), autotest, backup and _tmp collections are kept
+    """
     total_collections_to_remove = []
     for production_collection in production_collections:
-        collections_to_remove = [x for x in db.user_db.list_collection_names() if production_collection in x
+        collections_to_remove = [x for x in collection_names if production_collection in x
                                  and x != production_collection
                                  and tmp_table_name not in x
                                  and 'autotest' not in x
                                  and 'backup' not in x
                                  and x != '{}_tmp'.format(production_collection)]
         total_collections_to_remove.extend(collections_to_remove)
+    return total_collections_to_remove
+
+
+@loop_all_dbs()
+def purge_test_collections(clean=False):
+    total_collections_to_remove = test_collections(db.user_db.list_collection_names())
 
     if clean:
         for c in total_collections_to_remove:
@@ -206,3 +1068,105 @@ def purge_test_collections(clean=False):
     else:
         for col in total_collections_to_remove:
             print(col)
+
+
+def purge_database(database_name, clean=False, interval=0.0):
+    """
+    Worker of purge_test_collections_batched: list the collections of one database once and drop (or with
+    clean False only measure) its test collections, at most one drop per interval seconds
+    Returns:
+        dict with the database name, the test collections, the bytes they use (storage and indexes), the
+        number dropped and an error if one happened
+    """
+    result = {'database': database_name, 'collections': [], 'bytes': 0, 'dropped': 0}
+    try:
+        db.connect_by_database_id(database_name)
+        result['collections'] = test_collections(db.user_db.list_collection_names())
+        for name in result['collections']:
+            stats = db.user_db.command('collStats', name)
+            result['bytes'] += stats.get('storageSize', 0) + stats.get('totalIndexSize', 0)
+            if clean:
+                start = perf_counter()
+                db.user_db.drop_collection(name)
+                result['dropped'] += 1
+                sleep(max(0.0, interval - (perf_counter() - start)))
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    return result
+
+
+def purge_test_collections_batched(database_list, clean=False, workers=4, drops_per_second=5.0):
+    """
+    Batched purge_test_collections: the collections of every database are listed once and the databases are
+    purged in parallel by worker processes. Dry run unless clean is set, the reclaimable size is reported
+    either way.
+    Example usage:
+        purge_test_collections_batched(production_databases(), clean=True, workers=8)
+    Args:
+        database_list: list of database ids
+        clean: drop the collections, otherwise only list them
+        workers: number of worker processes
+        drops_per_second: limit of the drops of all workers together, spread evenly over the workers
+
+    Returns:
+        list of the purge_database results sorted by database
+    """
+    interval = workers / drops_per_second if drops_per_second else 0.0
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=connect_worker) as pool:
+        futures = [pool.submit(purge_database, name, clean, interval) for name in database_list]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if 'error' in result:
+                print(result['database'], 'error', result['error'])
+                continue
+            print('{} {} {} collections, {:.1f} MB'.format(
+                result['database'], 'dropped' if clean else 'would drop', len(result['collections']),
+                result['bytes'] / 2 ** 20))
+            if not clean:
+                for name in result['collections']:
+                    print('   ', name)
+
+    results.sort(key=lambda r: r['database'])
+    print('{} {} collections in {} databases, {:.1f} MB {}'.format(
+        'dropped' if clean else 'would drop', sum(len(r['collections']) for r in results), len(results),
+        sum(r['bytes'] for r in results) / 2 ** 20, 'reclaimed' if clean else 'reclaimable'))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Validate the pricing test collections of all production databases')
+    parser.add_argument('--check', choices=sorted(VALIDATION_CHECKS), default='promotion_internal_price')
+    parser.add_argument('--workers', help='databases validated in parallel', type=int, default=4)
+    parser.add_argument('--report', help='write the json report to this file')
+    parser.add_argument('--verbose-level', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--skip-matching', action='store_true',
+                        help='skip accounts whose document count and content fingerprint match')
+    parser.add_argument('--rtol', help='with --check pricing_data_columnar: relative tolerance of nsv_norm',
+                        type=float, default=0.0)
+    parser.add_argument('--atol', help='with --check pricing_data_columnar: absolute tolerance of nsv_norm',
+                        type=float, default=0.0)
+    parser.add_argument('--output', help='append every result to this .jsonl or .csv file as it finishes')
+    parser.add_argument('--state', help='checkpoint file of the finished databases and accounts',
+                        default='pricing_validation_state.jsonl')
+    parser.add_argument('--resume', action='store_true', help='skip what the checkpoint file lists as finished')
+    parser.add_argument('--retries', help='retries of a database after a connection failure', type=int, default=3)
+    parser.add_argument('--purge', action='store_true',
+                        help='list the test collections of every database instead of validating, see --clean')
+    parser.add_argument('--clean', action='store_true', help='with --purge: drop the listed collections')
+    parser.add_argument('--drops-per-second', help='with --purge: limit of the drops of all workers together',
+                        type=float, default=5.0)
+    args = parser.parse_args()
+
+    check_kwargs = {}
+    if args.check == 'promotion_internal_price':
+        check_kwargs = {'verbose_level': args.verbose_level, 'skip_matching': args.skip_matching}
+    elif args.check == 'pricing_data_columnar':
+        check_kwargs = {'rtol': args.rtol, 'atol': args.atol}
+    db.security_connect()
+    if args.purge:
+        purge_test_collections_batched(production_databases(), args.clean, args.workers, args.drops_per_second)
+    else:
+        run_validation(production_databases(), args.check, args.workers, args.report, args.output, args.state,
+                       args.resume, args.retries, **check_kwargs)
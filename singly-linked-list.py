@@ -1,4 +1,16 @@
+import argparse
+import random
+import sys
+import timeit
+import tracemalloc
+from array import array
+from itertools import zip_longest
+from time import perf_counter
+
+
 class Node:
+    __slots__ = ('data', 'next')
+
     def __init__(self, data):
         self.data = data
         self.next = None
@@ -8,9 +20,13 @@ class Node:
 class SinglyLinkedList:
     # Define the Linked List
     
-    def __init__(self):
-        # start with an empty list
+    def __init__(self, base=10):
+        # start with an empty list, as a number the nodes are its digits in this base, least significant first,
+        # eg. with base 1000 every node holds 3 decimal digits
+        self.base = base
         self.head = None
+        self.tail = None
+        self.size = 0
 
  
     def __iter__(self):
@@ -23,32 +39,40 @@ class SinglyLinkedList:
 
     def __len__(self):
         # Make it measurable
-        count = 0
-        current = self.head
-        while current:
-            count += 1
-            current = current.next
-        return count
+        return self.size
     
     
     def __getitem__(self, position):
         # Return the value of the list item at a position
-        if position < 0 or position >= len(self):
+        if position < 0 or position >= self.size:
             raise IndexError("Index out of range")
         
         current = self.head
-        for i in range(len(self)):
-            if i == position:
-                return current.data
+        for _ in range(position):
             current = current.next
+        return current.data
     
 
     def __add__(self, other):
-        # Add two SinglyLinkedList objects together
+        # Add two numbers stored as SinglyLinkedList objects digit by digit with a carry, in one pass
         if not isinstance(other, SinglyLinkedList):
             raise TypeError("Can only add another SinglyLinkedList")
+        if other.base != self.base:
+            raise ValueError("Can only add lists with the same base")
         
-        return self.concatenate_numbers_reversed() + other.concatenate_numbers_reversed()
+        result = type(self)(self.base)
+        base = self.base
+        carry = 0
+        for a, b in zip_longest(self, other, fillvalue=0):
+            # divmod instead of subtracting base once, so nodes holding values outside [0, base) still add up
+            carry, digit = divmod(carry + a + b, base)
+            result.append(digit)
+        if carry < 0:
+            raise ValueError("The sum is negative")
+        while carry:
+            carry, digit = divmod(carry, base)
+            result.append(digit)
+        return result
 
 
     def append(self, data):
@@ -56,49 +80,43 @@ class SinglyLinkedList:
         new_node = Node(data)
         if not self.head:  # If list is empty
             self.head = new_node
-            return
-        last = self.head
-        while last.next:  # Traverse to the end
-            last = last.next
-        last.next = new_node
+        else:
+            self.tail.next = new_node
+        self.tail = new_node
+        self.size += 1
 
 
     def display(self):
         # Print the linked list
-        current = self.head
-        while current:
-            print(current.data, end=" -> ")
-            current = current.next
+        for data in self:
+            print(data, end=" -> ")
         print("None")
     
    
     def concatenate_numbers_reversed(self):
         # Concatenate the list in reverse order
-        current = self.head
-        values = []
-        while current:
-            values.append(str(current.data))
-            current = current.next
+        values = [str(data) for data in self]
         return int(''.join(reversed(values)))
 
     
     def swap_by_value(self, val1, val2):
-        # Swap to nodes by their values
-        node1 = self.head
-        node2 = self.head
+        # Swap to nodes by their values, both are found in one traversal
+        node1 = None
+        node2 = None
         node1_prev = None
         node2_prev = None
         
-        while node1 is not None:
-            if node1.data == val1:
-                break
-            node1_prev = node1
-            node1 = node1.next
-        while node2 is not None:
-            if node2.data == val2:
-                break
-            node2_prev = node2
-            node2 = node2.next
+        prev = None
+        current = self.head
+        while current is not None and (node1 is None or node2 is None):
+            if node1 is None and current.data == val1:
+                node1, node1_prev = current, prev
+            elif node2 is None and current.data == val2:
+                node2, node2_prev = current, prev
+            prev = current
+            current = current.next
+        if node1 is None or node2 is None:
+            return
         
         if node1_prev is None:
             self.head = node2
@@ -109,50 +127,203 @@ class SinglyLinkedList:
         else:
             node2_prev.next = node1
         node1.next, node2.next = node2.next, node1.next
+        if self.tail is node1:
+            self.tail = node2
+        elif self.tail is node2:
+            self.tail = node1
     
     
     def last_nth(self, n):
-        # Return the last n-th node value
-        end = len(self)
-        return self[end - n]
+        # Return the last n-th node value, the size is known so this is a single walk
+        return self[self.size - n]
 
 
     def get_middle(self):
         # Return the middle node value
-        index = (len(self) - 1) // 2
-        return self[index]
+        return self[(self.size - 1) // 2]
 
-        
 
-ll = SinglyLinkedList()
-ll.append(10)
-ll.append(20)
-ll.append(30)
-ll.display()
-print(ll.concatenate_numbers_reversed())
-
-print([x for x in ll])
-print(len(ll))
-
-ll2 = SinglyLinkedList()
-ll2.append(100)
-ll2.append(200)
-ll2.append(300)
-print(ll + ll2)
-ll.display()
-ll.swap_by_value(10, 20)
-ll.display()
-print(ll[1])
-ll.append(40)
-ll.append(50)
-ll.display()
-print(ll.last_nth(2))
-print("middle: ", end='')
-ll.append(60)
-ll.append(70)
-ll.append(80)
-ll.append(5)
-ll.display()
-print(ll.get_middle())
-print(max(ll))
-print(min(ll))
+class CompactSinglyLinkedList(SinglyLinkedList):
+    # Same list without a Node object per item: node i is values[i] and next_index[i], the index of the next
+    # node (-1 at the end) in an array of C longs, head and tail are indexes too. There is no way to remove a
+    # node from this list so nodes are never freed.
+
+    def __init__(self, base=10):
+        super().__init__(base)
+        self.head = -1
+        self.tail = -1
+        self.values = []
+        self.next_index = array('l')
+
+
+    def __iter__(self):
+        values = self.values
+        next_index = self.next_index
+        current = self.head
+        while current != -1:
+            yield values[current]
+            current = next_index[current]
+
+
+    def __getitem__(self, position):
+        if position < 0 or position >= self.size:
+            raise IndexError("Index out of range")
+
+        current = self.head
+        for _ in range(position):
+            current = self.next_index[current]
+        return self.values[current]
+
+
+    def append(self, data):
+        index = len(self.values)
+        self.values.append(data)
+        self.next_index.append(-1)
+        if self.head == -1:
+            self.head = index
+        else:
+            self.next_index[self.tail] = index
+        self.tail = index
+        self.size += 1
+
+
+    def swap_by_value(self, val1, val2):
+        # Nodes are only reachable through their values here, so swapping the values swaps the nodes
+        index1 = None
+        index2 = None
+        current = self.head
+        while current != -1 and (index1 is None or index2 is None):
+            if index1 is None and self.values[current] == val1:
+                index1 = current
+            elif index2 is None and self.values[current] == val2:
+                index2 = current
+            current = self.next_index[current]
+        if index1 is None or index2 is None:
+            return
+        self.values[index1], self.values[index2] = self.values[index2], self.values[index1]
+
+
+def random_number(digits, base=10):
+    # A SinglyLinkedList number with the given count of decimal digits, base must be a power of 10
+    width = len(str(base - 1))
+    ll = SinglyLinkedList(base)
+    for _ in range(-(-digits // width)):
+        ll.append(random.randrange(base))
+    return ll
+
+
+def benchmark_add(digits):
+    # Add two numbers of the given digit count with the string round trip (concatenate_numbers_reversed and
+    # int) and with __add__ for a few node widths
+    sys.set_int_max_str_digits(0)  # the round trip is refused above 4300 digits otherwise
+    a = random_number(digits)
+    b = random_number(digits)
+    start = perf_counter()
+    a.concatenate_numbers_reversed() + b.concatenate_numbers_reversed()
+    print('{:<28}{:>11.1f} ms'.format('string round trip', (perf_counter() - start) * 1000))
+    for base in (10, 10 ** 4, 10 ** 9):
+        a = random_number(digits, base)
+        b = random_number(digits, base)
+        start = perf_counter()
+        a + b
+        print('{:<28}{:>11.1f} ms'.format('__add__ base {}'.format(base), (perf_counter() - start) * 1000))
+
+
+def benchmark_compact(size):
+    # Memory (tracemalloc) and iteration time (timeit) of a list of size items, pointer and array based, the
+    # items exist before so only the memory of the list itself is counted
+    items = list(range(size))
+    print('{:<26}{:>12}{:>14}{:>14}'.format('{} items'.format(size), 'MB', 'bytes/item', 'iterate ms'))
+    for list_type in (SinglyLinkedList, CompactSinglyLinkedList):
+        tracemalloc.start()
+        ll = list_type()
+        for item in items:
+            ll.append(item)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        iterate = min(timeit.repeat(lambda: sum(ll), number=1, repeat=3))
+        print('{:<26}{:>12.1f}{:>14.1f}{:>14.1f}'.format(
+            list_type.__name__, memory / 2 ** 20, memory / size, iterate * 1000))
+
+
+def benchmark(sizes):
+    # Time the list operations for growing sizes, the operations are O(1) or a single walk so the time per
+    # element should stay flat
+    print('{:>9}{:>11}{:>11}{:>11}{:>11}{:>11}{:>11}  (ms)'.format(
+        'size', 'append', 'len', 'last_nth', 'middle', 'swap', 'iterate'))
+    for size in sizes:
+        ll = SinglyLinkedList()
+        timings = []
+        start = perf_counter()
+        for i in range(size):
+            ll.append(i)
+        timings.append(perf_counter() - start)
+        for operation in (len, lambda l: l.last_nth(2), SinglyLinkedList.get_middle,
+                          lambda l: l.swap_by_value(size - 2, 1), lambda l: sum(1 for _ in l)):
+            start = perf_counter()
+            operation(ll)
+            timings.append(perf_counter() - start)
+        print('{:>9}'.format(size) + ''.join('{:>11.3f}'.format(timing * 1000) for timing in timings))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Singly linked list demo')
+    parser.add_argument('--benchmark', action='store_true', help='time the list operations from 10^3 to 10^6 items')
+    parser.add_argument('--benchmark-add', action='store_true', help='time adding two numbers of --digits digits')
+    parser.add_argument('--digits', type=int, default=10 ** 6)
+    parser.add_argument('--benchmark-compact', action='store_true',
+                        help='compare the memory and iteration time of the pointer and array based lists')
+    parser.add_argument('--size', type=int, default=10 ** 6)
+    args = parser.parse_args()
+
+    if args.benchmark or args.benchmark_add or args.benchmark_compact:
+        if args.benchmark:
+            benchmark([10 ** exponent for exponent in range(3, 7)])
+        if args.benchmark_add:
+            benchmark_add(args.digits)
+        if args.benchmark_compact:
+            benchmark_compact(args.size)
+        raise SystemExit()
+
+    ll = SinglyLinkedList()
+    ll.append(10)
+    ll.append(20)
+    ll.append(30)
+    ll.display()
+    print(ll.concatenate_numbers_reversed())
+
+    print([x for x in ll])
+    print(len(ll))
+
+    # nodes of up to 3 decimal digits
+    ll1 = SinglyLinkedList(1000)
+    ll1.append(10)
+    ll1.append(20)
+    ll1.append(30)
+    ll2 = SinglyLinkedList(1000)
+    ll2.append(100)
+    ll2.append(200)
+    ll2.append(300)
+    (ll1 + ll2).display()
+
+    digits = SinglyLinkedList()
+    for digit in (9, 9, 9):
+        digits.append(digit)
+    (digits + digits).display()
+    ll.display()
+    ll.swap_by_value(10, 20)
+    ll.display()
+    print(ll[1])
+    ll.append(40)
+    ll.append(50)
+    ll.display()
+    print(ll.last_nth(2))
+    print("middle: ", end='')
+    ll.append(60)
+    ll.append(70)
+    ll.append(80)
+    ll.append(5)
+    ll.display()
+    print(ll.get_middle())
+    print(max(ll))
+    print(min(ll))
@@ -1,5 +1,11 @@
+import argparse
+import timeit
+import tracemalloc
+from array import array
+from collections import deque
 from dataclasses import dataclass
 from faker import Faker
+from operator import attrgetter
 import random
 from time import perf_counter
 from typing import Optional, Iterator
@@ -8,6 +14,8 @@ from typing import Optional, Iterator
 fake = Faker('en_US')
 
 class Node:
+    __slots__ = ('data', 'next')
+
     def __init__(self, data: str, next: Optional['Node'] = None) -> None:
         self.data = data
         self.next = next
@@ -16,6 +24,7 @@ class Queue:
     def __init__(self):
         self.front = None
         self.rear = None
+        self.size = 0
         
     def enqueue(self, data) -> None:
         new_node = Node(data)
@@ -25,12 +34,16 @@ class Queue:
         else:
             self.rear.next = new_node
             self.rear = new_node
+        self.size += 1
         
     def dequeue(self) -> Optional['User']:
         if not self.front:
             return 'The queue is empty'
         data = self.front.data
         self.front = self.front.next
+        if not self.front:
+            self.rear = None
+        self.size -= 1
         return data
     
     def peek(self):
@@ -38,45 +51,281 @@ class Queue:
             return 'The queue is empty'
         return self.front.data
     
-    def sort_by_value(self, value: str) -> None:
+    def sort_by_value(self, value: str, *values: str, reverse: bool = False) -> None:
         if not self.front:
             return 'The queue is empty'
-        current = self.front
-        while True:
-            swapped = False
-            current = self.front
-            
-            while current and current.next:
-                if current.data.__dict__[value] > current.next.data.__dict__[value]:
-                    current.data, current.next.data = current.next.data, current.data
-                    swapped = True
-                current = current.next
-            if not swapped:
-                break
-    
-    def __len__(self):
-        count = 0
+        # stable O(n log n): the keys are read once per node, the nodes are sorted and relinked
+        key = attrgetter(value, *values)
+        nodes = []
         current = self.front
         while current:
-            count += 1
+            nodes.append(current)
             current = current.next
-        return count
+        nodes.sort(key=lambda node: key(node.data), reverse=reverse)
+        for node, next_node in zip(nodes, nodes[1:]):
+            node.next = next_node
+        nodes[-1].next = None
+        self.front = nodes[0]
+        self.rear = nodes[-1]
+    
+    def __len__(self):
+        return self.size
 
     def __getitem__(self, index: int) -> str:
-        if index < 0  or index >= len(self):
+        if index < 0  or index >= self.size:
             raise IndexError('Index out of range')
         current = self.front
-        for i in range(len(self)):
-            if i == index:
-                return current.data
+        for _ in range(index):
             current = current.next
+        return current.data
     
     def __iter__(self) -> Iterator[str]:
         current = self.front
         while current:
             yield current.data
             current = current.next
-            
+
+
+class ChunkedQueue:
+    # queue api of Queue, the items are kept in fixed size blocks (like collections.deque) instead of one node
+    # per item, indexing is O(1) and iterating walks contiguous lists
+    def __init__(self, block_size: int = 64):
+        self.block_size = block_size
+        self.blocks = [[]]
+        self.first = 0  # index of the front block in blocks, dequeued blocks are dropped in bulk
+        self.head = 0  # index of the front item in the front block
+        self.size = 0
+
+    def enqueue(self, data) -> None:
+        if len(self.blocks[-1]) == self.block_size:
+            self.blocks.append([])
+        self.blocks[-1].append(data)
+        self.size += 1
+
+    def dequeue(self) -> Optional['User']:
+        if not self.size:
+            return 'The queue is empty'
+        block = self.blocks[self.first]
+        data = block[self.head]
+        block[self.head] = None
+        self.head += 1
+        self.size -= 1
+        if not self.size:
+            self.blocks, self.first, self.head = [[]], 0, 0
+        elif self.head == self.block_size:
+            self.first += 1
+            self.head = 0
+            if self.first * 2 > len(self.blocks):
+                del self.blocks[:self.first]
+                self.first = 0
+        return data
+
+    def peek(self):
+        if not self.size:
+            return 'The queue is empty'
+        return self.blocks[self.first][self.head]
+
+    def sort_by_value(self, value: str, *values: str, reverse: bool = False) -> None:
+        if not self.size:
+            return 'The queue is empty'
+        items = sorted(self, key=attrgetter(value, *values), reverse=reverse)
+        self.blocks = [items[i:i + self.block_size] for i in range(0, len(items), self.block_size)]
+        self.first = 0
+        self.head = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0 or index >= self.size:
+            raise IndexError('Index out of range')
+        block, offset = divmod(self.head + index, self.block_size)
+        return self.blocks[self.first + block][offset]
+
+    def __iter__(self) -> Iterator[str]:
+        head = self.head
+        for block in self.blocks[self.first:]:
+            yield from block[head:]
+            head = 0
+
+
+class CompactQueue:
+    # queue api of Queue without a Node object per item: node i is values[i] and next_index[i], the index of
+    # the next node (-1 at the end) in an array of C longs. Dequeued nodes go on a free list chained through
+    # next_index and are reused by enqueue, so a queue which is drained and refilled doesn't grow
+    def __init__(self):
+        self.values = []
+        self.next_index = array('l')
+        self.front = -1
+        self.rear = -1
+        self.free = -1
+        self.size = 0
+
+    def enqueue(self, data) -> None:
+        if self.free != -1:
+            index = self.free
+            self.free = self.next_index[index]
+            self.values[index] = data
+            self.next_index[index] = -1
+        else:
+            index = len(self.values)
+            self.values.append(data)
+            self.next_index.append(-1)
+        if self.front == -1:
+            self.front = index
+        else:
+            self.next_index[self.rear] = index
+        self.rear = index
+        self.size += 1
+
+    def dequeue(self) -> Optional['User']:
+        if self.front == -1:
+            return 'The queue is empty'
+        index = self.front
+        data = self.values[index]
+        self.front = self.next_index[index]
+        if self.front == -1:
+            self.rear = -1
+        self.values[index] = None
+        self.next_index[index] = self.free
+        self.free = index
+        self.size -= 1
+        return data
+
+    def peek(self):
+        if self.front == -1:
+            return 'The queue is empty'
+        return self.values[self.front]
+
+    def sort_by_value(self, value: str, *values: str, reverse: bool = False) -> None:
+        if self.front == -1:
+            return 'The queue is empty'
+        # the nodes keep their place in the chain and get the sorted values
+        current = self.front
+        for data in sorted(self, key=attrgetter(value, *values), reverse=reverse):
+            self.values[current] = data
+            current = self.next_index[current]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0 or index >= self.size:
+            raise IndexError('Index out of range')
+        current = self.front
+        for _ in range(index):
+            current = self.next_index[current]
+        return self.values[current]
+
+    def __iter__(self) -> Iterator[str]:
+        values = self.values
+        next_index = self.next_index
+        current = self.front
+        while current != -1:
+            yield values[current]
+            current = next_index[current]
+
+
+class Handle:
+    # entry of a PriorityQueue, returned by enqueue to update or remove the item later
+    __slots__ = ('data', 'key', 'count', 'index')
+
+    def __init__(self, data, key, count: int) -> None:
+        self.data = data
+        self.key = key
+        self.count = count
+        self.index = 0
+
+    def __lt__(self, other: 'Handle') -> bool:
+        # equal keys come out in the order they were enqueued
+        return (self.key, self.count) < (other.key, other.count)
+
+
+class PriorityQueue:
+    # queue api of Queue with the items coming out ordered on User attributes instead of in arrival order,
+    # backed by a binary heap: O(log n) enqueue, dequeue, update and remove, O(1) peek
+    def __init__(self, value: str, *values: str):
+        self.key = attrgetter(value, *values)
+        self.heap = []
+        self.count = 0
+
+    def enqueue(self, data) -> Handle:
+        handle = Handle(data, self.key(data), self.count)
+        self.count += 1
+        handle.index = len(self.heap)
+        self.heap.append(handle)
+        self._sift_up(handle.index)
+        return handle
+
+    def dequeue(self) -> Optional['User']:
+        if not self.heap:
+            return 'The queue is empty'
+        return self.remove(self.heap[0])
+
+    def peek(self):
+        if not self.heap:
+            return 'The queue is empty'
+        return self.heap[0].data
+
+    def update(self, handle: Handle) -> None:
+        # re-read the key after the attributes of handle.data changed, eg. a decreased age
+        if handle.index >= len(self.heap) or self.heap[handle.index] is not handle:
+            raise ValueError('Handle not in the queue')
+        handle.key = self.key(handle.data)
+        self._sift_up(handle.index)
+        self._sift_down(handle.index)
+
+    def remove(self, handle: Handle):
+        index = handle.index
+        if index >= len(self.heap) or self.heap[index] is not handle:
+            raise ValueError('Handle not in the queue')
+        last = self.heap.pop()
+        if last is not handle:
+            last.index = index
+            self.heap[index] = last
+            self._sift_up(index)
+            self._sift_down(last.index)
+        return handle.data
+
+    def _sift_up(self, index: int) -> None:
+        heap = self.heap
+        handle = heap[index]
+        while index:
+            parent = (index - 1) // 2
+            if not handle < heap[parent]:
+                break
+            heap[index] = heap[parent]
+            heap[index].index = index
+            index = parent
+        heap[index] = handle
+        handle.index = index
+
+    def _sift_down(self, index: int) -> None:
+        heap = self.heap
+        handle = heap[index]
+        size = len(heap)
+        while True:
+            child = 2 * index + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if not heap[child] < handle:
+                break
+            heap[index] = heap[child]
+            heap[index].index = index
+            index = child
+        heap[index] = handle
+        handle.index = index
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self) -> Iterator[str]:
+        # priority order, without dequeuing
+        for handle in sorted(self.heap):
+            yield handle.data
+
 
 @dataclass
 class User:
@@ -84,8 +333,119 @@ class User:
     age: int
 
 
+def benchmark_queues(sizes: list, lookups: int = 1000) -> None:
+    for size in sizes:
+        print('\n{:=^70}'.format(f' {size} users '))
+        users = [User(str(i), 21 + i % 45) for i in range(size)]
+        positions = [random.randrange(size) for _ in range(lookups)]
+        print('{:<14}{:>11}{:>11}{:>11}{:>11}{:>11}  (ms)'.format(
+            '', 'enqueue', f'{lookups} len', f'{lookups} [i]', 'iterate', 'dequeue'))
+        for name, queue_type in [('Queue', Queue), ('ChunkedQueue', ChunkedQueue), ('deque', deque)]:
+            queue = queue_type()
+            add = queue.append if queue_type is deque else queue.enqueue
+            remove = queue.popleft if queue_type is deque else queue.dequeue
+            timings = []
+            start_time = perf_counter()
+            for user in users:
+                add(user)
+            timings.append(perf_counter() - start_time)
+            start_time = perf_counter()
+            for _ in range(lookups):
+                len(queue)
+            timings.append(perf_counter() - start_time)
+            start_time = perf_counter()
+            for position in positions:
+                queue[position]
+            timings.append(perf_counter() - start_time)
+            start_time = perf_counter()
+            for _ in queue:
+                pass
+            timings.append(perf_counter() - start_time)
+            start_time = perf_counter()
+            for _ in range(size):
+                remove()
+            timings.append(perf_counter() - start_time)
+            print('{:<14}'.format(name) + ''.join(f'{timing * 1000:>11.2f}' for timing in timings))
+
+
+def benchmark_sort(sizes: list) -> None:
+    sorts = [('age', ), ('name', ), ('age', 'name')]
+    print('\n{:=^70}'.format(' sort_by_value '))
+    print('{:<8}{:<14}'.format('users', '') + ''.join('{:>12}'.format(','.join(values)) for values in sorts) +
+          '{:>12}  (ms)'.format('age reverse'))
+    for size in sizes:
+        users = [User(fake.name(), random.randint(21, 65)) for _ in range(size)]
+        for name, queue_type in [('Queue', Queue), ('ChunkedQueue', ChunkedQueue), ('sorted list', list)]:
+            timings = []
+            for values, reverse in [(values, False) for values in sorts] + [(('age', ), True)]:
+                queue = queue_type()
+                if queue_type is list:
+                    queue.extend(users)
+                    sort = lambda: sorted(queue, key=attrgetter(*values), reverse=reverse)
+                else:
+                    for user in users:
+                        queue.enqueue(user)
+                    sort = lambda: queue.sort_by_value(*values, reverse=reverse)
+                start_time = perf_counter()
+                sort()
+                timings.append(perf_counter() - start_time)
+            print('{:<8}{:<14}'.format(size, name) + ''.join(f'{timing * 1000:>12.2f}' for timing in timings))
+
+
+def benchmark_compact(size: int) -> None:
+    # memory (tracemalloc) of the queue itself, the users exist before, and iteration time (timeit)
+    users = [User(str(i), 21 + i % 45) for i in range(size)]
+    print('\n{:=^70}'.format(f' {size} users '))
+    print('{:<16}{:>12}{:>14}{:>14}'.format('', 'MB', 'bytes/user', 'iterate ms'))
+    for queue_type in (Queue, CompactQueue, ChunkedQueue):
+        tracemalloc.start()
+        queue = queue_type()
+        for user in users:
+            queue.enqueue(user)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        iterate = min(timeit.repeat(lambda: deque(queue, maxlen=0), number=1, repeat=3))
+        print('{:<16}{:>12.1f}{:>14.1f}{:>14.1f}'.format(
+            queue_type.__name__, memory / 2 ** 20, memory / size, iterate * 1000))
+
+
+def benchmark_priority(sizes: list, rounds: int = 200) -> None:
+    # a user joins and the youngest user is served, with Queue that means sorting the whole queue every time
+    print('\n{:=^70}'.format(f' {rounds} x enqueue + youngest out '))
+    for size in sizes:
+        users = [User(fake.name(), random.randint(21, 65)) for _ in range(size + rounds)]
+        for name, queue in [('Queue + sort', Queue()), ('PriorityQueue', PriorityQueue('age'))]:
+            for user in users[:size]:
+                queue.enqueue(user)
+            start_time = perf_counter()
+            for user in users[size:]:
+                queue.enqueue(user)
+                if isinstance(queue, Queue):
+                    queue.sort_by_value('age')
+                queue.dequeue()
+            print('{:<8}{:<16}{:>12.2f} ms'.format(size, name, (perf_counter() - start_time) * 1000))
+
+
 if __name__ == '__main__':
-    
+    parser = argparse.ArgumentParser(description='User queue demo')
+    parser.add_argument('--benchmark', action='store_true', help='compare the queue types instead of the demo')
+    parser.add_argument('--sizes', help='comma separated queue sizes to benchmark', default='1000,10000,50000')
+    parser.add_argument('--benchmark-compact', action='store_true',
+                        help='compare the memory and iteration time of the queue storages at --size users')
+    parser.add_argument('--size', type=int, default=10 ** 6)
+    args = parser.parse_args()
+
+    if args.benchmark_compact:
+        benchmark_compact(args.size)
+        raise SystemExit()
+
+    if args.benchmark:
+        sizes = [int(size) for size in args.sizes.split(',')]
+        benchmark_queues(sizes)
+        benchmark_sort(sizes)
+        benchmark_priority(sizes)
+        raise SystemExit()
+
     user_list = []
 
 
@@ -126,18 +486,29 @@ if __name__ == '__main__':
     print(f'\nMiddle aged users sorted by age: {middle_aged_user_ages_sorted}')
 
 
-    start_time = perf_counter()
     middle_aged_user_queue.sort_by_value('age')
     print(f'\nMiddle aged users queue sorted by age: ')
     for u in middle_aged_user_queue:
         print(f'{u.name}, {u.age}')
-    end_time = perf_counter()
-    print(f'\nTime taken to sort: {end_time - start_time} seconds')
 
-    start_time = perf_counter()
     middle_aged_user_queue.sort_by_value('name')
     print(f'\nMiddle aged users queue sorted by name: ')
     for u in middle_aged_user_queue:
         print(f'{u.name}, {u.age}')
-    end_time = perf_counter()
-    print(f'\nTime taken to sort: {end_time - start_time} seconds')
+
+    middle_aged_user_queue.sort_by_value('age', 'name', reverse=True)
+    print(f'\nMiddle aged users queue sorted by age and name, oldest first: ')
+    for u in middle_aged_user_queue:
+        print(f'{u.name}, {u.age}')
+
+    user_priority_queue = PriorityQueue('age')
+    handles = [user_priority_queue.enqueue(u) for u in user_list]
+    print(f'\nYoungest user: {user_priority_queue.peek().name}, {user_priority_queue.peek().age}')
+    handles[-1].data.age = 18
+    user_priority_queue.update(handles[-1])
+    print(f'\nYoungest user after {handles[-1].data.name} turned 18: {user_priority_queue.peek().name}')
+    user_priority_queue.remove(handles[-1])
+    user_data = user_priority_queue.dequeue()
+    print(f'\nYoungest user dequeued after removing them: {user_data.name}, {user_data.age}')
+
+    print('\nRun with --benchmark to time the queues, sort_by_value and the priority queue')